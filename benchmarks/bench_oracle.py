@@ -0,0 +1,63 @@
+"""
+    Compares the schema based loading of the oracles with the fast path (libyaml loader and single-pass validation) on
+    a synthetic oracle.
+
+    Usage: python benchmarks/bench_oracle.py [--cases 50000] [--repeat 3]
+"""
+import argparse
+import tempfile
+import timeit
+
+from pathlib import Path
+
+import yaml
+
+from orbis.data.schema import get_oracle, read_tests, load_yaml, parse_oracle
+
+
+def write_oracle(path: Path, cases: int):
+    oracle = {
+        'script': 'run_test.sh',
+        'cwd': 'tests',
+        'cases': {f"test_{i}": {'order': i, 'file': f"tests/case_{i % 500}.sh", 'timeout': 10, 'args': f"--id {i}"}
+                  for i in range(cases)}
+    }
+
+    with path.open(mode="w") as stream:
+        yaml.safe_dump(oracle, stream)
+
+
+def schema_path(path: Path):
+    with path.open(mode="r") as stream:
+        return get_oracle(is_pov=False).validate(yaml.safe_load(stream))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', type=int, default=50000, help='Number of test cases in the oracle.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of repetitions (best is reported).')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / 'tests.orbis.yaml'
+        write_oracle(path, args.cases)
+        assert schema_path(path) == read_tests(path), "fast path and schema path differ"
+
+        with path.open(mode="r") as stream:
+            data = load_yaml(stream)
+
+        results = {
+            'schema (yaml.safe_load + schema)': lambda: schema_path(path),
+            'fast (libyaml + single pass)': lambda: read_tests(path),
+            'validation only, schema': lambda: get_oracle(is_pov=False).validate(data),
+            'validation only, single pass': lambda: parse_oracle(data),
+        }
+
+        print(f"{args.cases} cases, best of {args.repeat}")
+
+        for name, func in results.items():
+            print(f"{name:<35} {min(timeit.repeat(func, number=1, repeat=args.repeat)):.3f}s")
+
+
+if __name__ == '__main__':
+    main()
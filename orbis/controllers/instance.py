@@ -75,7 +75,7 @@ class Instance(Controller):
         benchmark_handler = self.app.handler.get('handlers', self.app.plugin.benchmark, setup=True)
         benchmark_handler.set(project=self.context.project)
         cmd_data, _ = benchmark_handler.build(context=self.context, **self.args)
-        benchmark_handler.build_handler.save_outcome(cmd_data, self.context)
+        benchmark_handler.build_handler.save_outcome(cmd_data, self.context, args=self.args)
         benchmark_handler.unset()
 
     @ex(
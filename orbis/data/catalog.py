@@ -0,0 +1,130 @@
+from copy import deepcopy
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import RLock
+from typing import List, Dict, Tuple
+
+from orbis.data.schema import Project, Manifest, Vulnerability, OracleCache, parse_project
+from orbis.data.snapshot import Snapshot, content_hash
+
+
+@dataclass
+class CatalogIndex:
+    """
+        Data object with the lookup tables of the dataset: project id to project, vulnerability id to
+        (project, manifest, vulnerability), and commit sha to (project, manifest).
+    """
+    projects: Dict[str, Project] = field(default_factory=lambda: {})
+    vulns: Dict[str, Tuple[Project, Manifest, Vulnerability]] = field(default_factory=lambda: {})
+    commits: Dict[str, Tuple[Project, Manifest]] = field(default_factory=lambda: {})
+
+    @staticmethod
+    def build(projects: List[Project]):
+        """
+            Indexes the projects. In case of duplicates, the first occurrence wins.
+        """
+        index = CatalogIndex()
+
+        for project in projects:
+            index.projects.setdefault(project.id, project)
+
+            for m in project.manifest:
+                index.commits.setdefault(m.commit, (project, m))
+
+                for vid, vuln in m.vulns.items():
+                    index.vulns.setdefault(vid, (project, m, vuln))
+
+        return index
+
+
+class Catalog:
+    """
+        Long-lived view of the dataset. Projects are parsed once and re-parsed only when their entry in the dataset
+        changes. Their oracles are loaded on first access through the oracle cache, which reads again the oracle files
+        (tests.orbis.yaml / povs.orbis.yaml) that change. When a snapshot is supplied, the parsed projects are also kept on
+        disk and reused by later runs while their dataset entry is the same.
+    """
+
+    def __init__(self, corpus_path: Path, snapshot: Snapshot = None, oracles: OracleCache = None):
+        self.corpus_path = corpus_path
+        self.snapshot = snapshot
+        self.oracles = oracles
+        self._entries: Dict[str, dict] = {}
+        self._projects: Dict[str, Project] = {}
+        self._index: CatalogIndex = None
+        self._lock = RLock()
+
+    def get_projects(self, dataset: dict, load: bool = True) -> List[Project]:
+        """
+            Returns the projects in the dataset, refreshing the ones that changed since the last call.
+
+            :param dataset: the dataset from the benchmark configs
+            :param load: loads the oracles of the projects through the oracle cache, on first access. Otherwise, the
+                        oracles are loaded on first access and kept with the project.
+        """
+        with self._lock:
+            for repo_path in list(self._projects):
+                if repo_path not in dataset:
+                    self.invalidate(repo_path)
+
+            projects = [self._refresh(repo_path, entry, load) for repo_path, entry in dataset.items()]
+
+            if self._index is None:
+                self._index = CatalogIndex.build(projects)
+
+            return projects
+
+    def get_index(self, dataset: dict, load: bool = True) -> CatalogIndex:
+        """
+            Returns the lookup tables for the projects in the dataset. The index is built when the dataset is loaded and
+            rebuilt only when a project is refreshed.
+        """
+        with self._lock:
+            self.get_projects(dataset, load=load)
+
+            return self._index
+
+    def invalidate(self, repo_path: str = None):
+        """
+            Drops the cached project (or all projects if none specified) so that it is parsed on the next access.
+        """
+        with self._lock:
+            self._index = None
+
+            if repo_path is None:
+                self._entries.clear()
+                self._projects.clear()
+            else:
+                self._entries.pop(repo_path, None)
+                self._projects.pop(repo_path, None)
+
+    def _parse(self, repo_path: str, entry: dict) -> Project:
+        """
+            Parses the project, going through the snapshot when available.
+        """
+        if self.snapshot is None:
+            return parse_project(repo_path, entry, corpus_path=self.corpus_path)
+
+        name = f"{self.corpus_path}:{repo_path}"
+        key = content_hash(str(self.corpus_path), repo_path, repr(entry))
+        project = self.snapshot.load(name, key)
+
+        if project is None:
+            project = parse_project(repo_path, entry, corpus_path=self.corpus_path)
+            self.snapshot.save(name, key, project)
+
+        return project
+
+    def _refresh(self, repo_path: str, entry: dict, load: bool) -> Project:
+        project = self._projects.get(repo_path, None)
+
+        if project is None or self._entries[repo_path] != entry:
+            project = self._parse(repo_path, entry)
+            self._entries[repo_path] = deepcopy(entry)
+            self._projects[repo_path] = project
+            self._index = None
+
+        if load and self.oracles is not None:
+            project.bind_oracles(self.oracles)
+
+        return project
@@ -0,0 +1,117 @@
+import os
+
+from collections.abc import MutableMapping
+from typing import Mapping, Optional, Dict, Iterator
+
+# marks the variables unset by an overlay
+_UNSET = object()
+
+
+class EnvOverlay(MutableMapping):
+    """
+        Environment made of a parent (the environment of orbis by default) and the variables set or unset on top of it.
+        The variables of the parent are not copied: lookups go through the chain of overlays, and the environment is only
+        materialized when the command is spawned. Child overlays can be created from a shared overlay (e.g., per project
+        and per command) without changing it.
+    """
+
+    def __init__(self, parent: Mapping = None, deltas: Mapping = None):
+        self.parent = os.environ if parent is None else parent
+        self._deltas: Dict[str, object] = {}
+
+        if deltas:
+            self.update(deltas)
+
+    def child(self, deltas: Mapping = None) -> 'EnvOverlay':
+        return EnvOverlay(self, deltas)
+
+    def copy(self) -> 'EnvOverlay':
+        env = EnvOverlay(self.parent)
+        env._deltas = self._deltas.copy()
+
+        return env
+
+    def __getitem__(self, key: str) -> str:
+        value = self._deltas.get(key, None)
+
+        if value is _UNSET:
+            raise KeyError(key)
+
+        if value is None:
+            return self.parent[key]
+
+        return value
+
+    def __setitem__(self, key: str, value: str):
+        self._deltas[key] = str(value)
+
+    def __delitem__(self, key: str):
+        if key not in self:
+            raise KeyError(key)
+
+        self._deltas[key] = _UNSET
+
+    def __contains__(self, key) -> bool:
+        value = self._deltas.get(key, None)
+
+        if value is None:
+            return key in self.parent
+
+        return value is not _UNSET
+
+    def __iter__(self) -> Iterator[str]:
+        for key in self.parent:
+            if self._deltas.get(key, None) is not _UNSET:
+                yield key
+
+        for key, value in self._deltas.items():
+            if value is not _UNSET and key not in self.parent:
+                yield key
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    @property
+    def changed(self) -> bool:
+        """
+            Whether the overlay, or any overlay in the chain, differs from the environment of orbis.
+        """
+        if self._deltas:
+            return True
+
+        return self.parent.changed if isinstance(self.parent, EnvOverlay) else self.parent is not os.environ
+
+    def materialize(self) -> Optional[Dict[str, str]]:
+        """
+            Returns the variables as a dict for spawning a command, or None when they are the same as the environment of
+            orbis, in which case the command inherits it without a copy.
+        """
+        if not self.changed:
+            return None
+
+        if isinstance(self.parent, EnvOverlay):
+            env = self.parent.materialize()
+            env = dict(os.environ) if env is None else env
+        else:
+            env = dict(self.parent)
+
+        for key, value in self._deltas.items():
+            if value is _UNSET:
+                env.pop(key, None)
+            else:
+                env[key] = value
+
+        return env
+
+    def __repr__(self):
+        return f"EnvOverlay({ {k: ('<unset>' if v is _UNSET else v) for k, v in self._deltas.items()} })"
+
+
+def materialize(env: Optional[Mapping]) -> Optional[Mapping]:
+    """
+        Returns the environment to spawn a command with: overlays are materialized, other mappings are used as they are.
+    """
+    if isinstance(env, EnvOverlay):
+        return env.materialize()
+
+    return env
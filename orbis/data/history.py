@@ -0,0 +1,101 @@
+from dataclasses import dataclass, field
+from statistics import median
+from typing import Dict, List, Optional, Tuple
+
+from orbis.data.schema import Test
+
+
+@dataclass
+class TestStats:
+    """
+        Data object with the outcomes of the past runs of a test case: the builds (compile outcomes) of the instances it
+        ran on, and the builds on which it both passed and failed. The percentile of the durations of the runs that did
+        not time out (and their number) is only loaded for learning the timeout of the test.
+    """
+    name: str
+    is_pov: bool = False
+    runs: int = 0
+    failures: int = 0
+    duration: float = 0
+    builds: int = 0
+    mixed: int = 0
+    timed_runs: int = 0
+    percentile_duration: float = None
+
+    @property
+    def failure_rate(self) -> float:
+        # smoothed, so that a few runs do not rule out (or in) the failure of the test
+        return (self.failures + 1) / (self.runs + 2)
+
+    @property
+    def flakiness(self) -> float:
+        return self.mixed / self.builds if self.builds else 0.0
+
+
+@dataclass
+class TestHistory:
+    """
+        Data object with the stats of the test cases of a project, for prioritizing the test cases that are most likely
+        to fail, per second of execution. The stats are keyed by the name of the test case and whether it is a pov.
+    """
+    stats: Dict[Tuple[str, bool], TestStats] = field(default_factory=lambda: {})
+
+    def get(self, test: Test) -> Optional[TestStats]:
+        return self.stats.get((test.id, bool(test.is_pov)), None)
+
+    def expected_duration(self, test: Test) -> float:
+        stats = self.get(test)
+
+        if stats and stats.runs:
+            return max(stats.duration, 1e-3)
+
+        if test.timeout:
+            return float(test.timeout)
+
+        known = [s.duration for s in self.stats.values() if s.runs]
+
+        return max(median(known), 1e-3) if known else 1.0
+
+    def failure_rate(self, test: Test) -> float:
+        stats = self.get(test)
+
+        return stats.failure_rate if stats else TestStats(name=test.id).failure_rate
+
+    def flakiness(self, test: Test) -> float:
+        stats = self.get(test)
+
+        return stats.flakiness if stats else 0.0
+
+    def is_flaky(self, test: Test, threshold: float = 0) -> bool:
+        """
+            Checks if the test case passed and failed on the same build in more than the threshold of the builds.
+        """
+        return self.flakiness(test) > threshold
+
+    def expects_pass(self, test: Test) -> bool:
+        """
+            Checks if the test case mostly passed in the past runs.
+        """
+        return self.failure_rate(test) <= 0.5
+
+    def timeout(self, test: Test, factor: float = 2, min_runs: int = 5) -> Optional[float]:
+        """
+            Returns the timeout learned from the durations of the past runs of the test case: the percentile of the
+            durations (loaded with the history) times the safety factor. Returns None when there are not enough runs
+            to learn it from.
+        """
+        stats = self.get(test)
+
+        if not stats or stats.percentile_duration is None or stats.timed_runs < max(min_runs, 1):
+            return None
+
+        return stats.percentile_duration * factor
+
+    def priority(self, test: Test) -> float:
+        return self.failure_rate(test) / self.expected_duration(test)
+
+    def prioritize(self, tests: List[Test]) -> List[Test]:
+        """
+            Returns the test cases sorted by priority. Ties keep the order of the test cases.
+        """
+        return sorted(tests, key=lambda t: (-self.priority(t), t.order))
@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Mapping, Optional, Iterator
+
+from orbis.data.results import CommandData
+from orbis.data.snapshot import Snapshot, content_hash
+
+
+@dataclass
+class Memo:
+    """
+        Data object declaring what a deterministic command depends on and produces, for memoizing it: the input files
+        (or directories), the output files (or directories) restored on a hit, and the names of the env variables that
+        change its result. Relative paths are relative to the working directory of the command.
+    """
+    inputs: List[Path] = field(default_factory=lambda: [])
+    outputs: List[Path] = field(default_factory=lambda: [])
+    env: List[str] = field(default_factory=lambda: [])
+
+
+def _resolve(cwd: Optional[str], path: Path) -> Path:
+    path = Path(path)
+
+    return path if path.is_absolute() or cwd is None else Path(cwd) / path
+
+
+def _files(path: Path) -> Iterator[Path]:
+    if path.is_dir():
+        yield from sorted(p for p in path.rglob('*') if p.is_file())
+    else:
+        yield path
+
+
+class CommandCache:
+    """
+        On-disk cache of the results of memoized commands, keyed by the command, its working directory, the declared env
+        variables and the content of the declared inputs. Each entry keeps the CommandData results and a copy of the
+        declared outputs, which are restored in place on a hit.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.records = Snapshot(path / 'records')
+
+    def key(self, cmd_data: CommandData, memo: Memo, env: Mapping[str, str] = None) -> str:
+        env = os.environ if env is None else env
+        parts = [cmd_data.cmd_str, str(cmd_data.cwd)]
+        parts.extend(f"{name}={env.get(name, '')}" for name in sorted(memo.env))
+
+        for path in memo.inputs:
+            for file in _files(_resolve(cmd_data.cwd, path)):
+                parts.extend([str(file), file])
+
+        return content_hash(*parts)
+
+    def restore(self, key: str, cmd_data: CommandData, memo: Memo) -> bool:
+        """
+            Restores the outputs and the results of the command from the entry with the key. Returns False if there is
+            no (complete) entry for the key.
+        """
+        record = self.records.load(key, key)
+        files = self.path / 'files' / key
+
+        if record is None or not all((files / str(i)).exists() for i in range(len(memo.outputs))):
+            return False
+
+        for i, output in enumerate(memo.outputs):
+            stored, dest = files / str(i), _resolve(cmd_data.cwd, output)
+
+            if stored.is_dir():
+                shutil.copytree(str(stored), str(dest), symlinks=True, dirs_exist_ok=True)
+            else:
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(str(stored), str(dest))
+
+        for attr, value in record.items():
+            setattr(cmd_data, attr, value)
+
+        cmd_data.memoized = True
+
+        return True
+
+    def save(self, key: str, cmd_data: CommandData, memo: Memo):
+        """
+            Stores the outputs and the results of the command under the key. The outputs are copied to a temporary
+            directory and moved into place, to be safe for concurrent runs.
+        """
+        files = self.path / 'files' / key
+
+        try:
+            files.parent.mkdir(parents=True, exist_ok=True)
+            tmp_dir = Path(tempfile.mkdtemp(prefix=f"{key}.", dir=str(files.parent)))
+        except OSError:
+            return
+
+        try:
+            for i, output in enumerate(memo.outputs):
+                src = _resolve(cmd_data.cwd, output)
+
+                if src.is_dir():
+                    shutil.copytree(str(src), str(tmp_dir / str(i)), symlinks=True)
+                else:
+                    shutil.copy2(str(src), str(tmp_dir / str(i)))
+
+            shutil.rmtree(str(files), ignore_errors=True)
+            os.replace(str(tmp_dir), str(files))
+        except OSError:
+            shutil.rmtree(str(tmp_dir), ignore_errors=True)
+            return
+
+        self.records.save(key, key, {'output': cmd_data.output, 'error': cmd_data.error,
+                                     'exit_status': cmd_data.exit_status, 'usage': cmd_data.usage})
@@ -1,23 +1,114 @@
-import os
-from typing import AnyStr, Dict
+import re
+import shlex
+import sys
+
+from typing import AnyStr, List, Union, Tuple, Mapping
 from dataclasses import dataclass, field
 from datetime import datetime
 
+from orbis.data.env import EnvOverlay
+
+# characters that need a shell to be interpreted (expansions, redirections, pipes, globs, ...)
+SHELL_CHARS = re.compile(r"[|&;<>()$`\\\n*?\[\]{}~!#]")
+SHELL_BUILTINS = frozenset(['.', 'source', 'cd', 'export', 'unset', 'set', 'alias', 'eval', 'exec', 'exit', 'ulimit',
+                            'umask', 'trap', 'wait', 'read', 'shift'])
+
+
+@dataclass
+class Usage:
+    """
+        Data object for the resources used by a command (including its children that it waited for), as reported by
+        rusage. The peak RSS is in kilobytes and the I/O is the bytes read from and written to the block devices.
+    """
+    user_time: float = 0
+    sys_time: float = 0
+    max_rss: int = 0
+    vol_ctx_switches: int = 0
+    invol_ctx_switches: int = 0
+    read_bytes: int = 0
+    write_bytes: int = 0
+    # only available when the command runs in a cgroup: peak memory in bytes and number of OOM kills
+    memory_peak: int = None
+    oom_kills: int = None
+
+    @staticmethod
+    def from_rusage(rusage) -> 'Usage':
+        return Usage(user_time=round(rusage.ru_utime, 6), sys_time=round(rusage.ru_stime, 6),
+                     # macOS reports the peak RSS in bytes
+                     max_rss=rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss,
+                     vol_ctx_switches=rusage.ru_nvcsw, invol_ctx_switches=rusage.ru_nivcsw,
+                     # block operations are counted in units of 512 bytes
+                     read_bytes=rusage.ru_inblock * 512, write_bytes=rusage.ru_oublock * 512)
+
+    def to_dict(self):
+        return {'user_time': self.user_time, 'sys_time': self.sys_time, 'max_rss': self.max_rss,
+                'vol_ctx_switches': self.vol_ctx_switches, 'invol_ctx_switches': self.invol_ctx_switches,
+                'read_bytes': self.read_bytes, 'write_bytes': self.write_bytes, 'memory_peak': self.memory_peak,
+                'oom_kills': self.oom_kills}
+
 
 @dataclass
 class CommandData:
-    args: str
-    env: Dict[str, str] = field(default_factory=lambda: os.environ.copy())
+    """
+        Data object for a command and its results. The args can be a command string or an argv list. The shell mode
+        tells how the command is spawned: True runs it through /bin/sh, False spawns the program directly, and None
+        (default) spawns directly the argv lists and the command strings that do not need a shell.
+    """
+    args: Union[str, List[str]]
+    env: Mapping[str, str] = field(default_factory=EnvOverlay)
     cwd: str = None
     pid: int = None
+    # unique id of the run of the command, for the channel of its events (pids are reused)
+    cmd_id: str = None
+    # the command runs in its own session, its process group is where its processes are tracked
+    pgid: int = None
     exit_status: int = 0
     duration: float = 0
     start: datetime = None
     end: datetime = None
     output: AnyStr = None
     error: AnyStr = None
+    output_file: str = None
+    error_file: str = None
     timeout: int = None
+    timed_out_at: datetime = None
     returns: dict = field(default_factory=lambda: {})
+    shell: bool = None
+    usage: Usage = None
+    # the results were restored from the command cache
+    memoized: bool = False
+
+    @property
+    def cmd_str(self) -> str:
+        return self.args if isinstance(self.args, str) else ' '.join(shlex.quote(arg) for arg in self.args)
+
+    @property
+    def program(self) -> str:
+        argv = self.args.split() if isinstance(self.args, str) else self.args
+
+        return argv[0] if argv else ''
+
+    def get_spawn_args(self) -> Tuple[Union[str, List[str]], bool]:
+        """
+            Returns the args to spawn the command with and whether they go through the shell.
+        """
+        if isinstance(self.args, str):
+            if self.shell is False or (self.shell is None and not SHELL_CHARS.search(self.args)):
+                try:
+                    argv = shlex.split(self.args)
+                except ValueError:
+                    # unbalanced quotes, left for the shell to report
+                    argv = None
+
+                if argv and (self.shell is False or (argv[0] not in SHELL_BUILTINS and '=' not in argv[0])):
+                    return argv, False
+
+            return self.args, True
+
+        if self.shell:
+            return self.cmd_str, True
+
+        return list(self.args), False
 
     def __getitem__(self, key: str):
         return self.returns[key]
@@ -29,8 +120,12 @@ class CommandData:
         return iter(self.returns)
 
     def to_dict(self):
-        return {'args': self.args, 'exit_status': self.exit_status, 'duration': self.duration, 'start': str(self.start),
-                'end': str(self.end), 'error': self.error, 'timeout': self.timeout, 'returns': self.returns}
+        return {'args': self.cmd_str, 'exit_status': self.exit_status, 'duration': self.duration, 'start': str(self.start),
+                'end': str(self.end), 'error': self.error, 'timeout': self.timeout, 'returns': self.returns,
+                'output_file': self.output_file, 'error_file': self.error_file,
+                'timed_out_at': str(self.timed_out_at) if self.timed_out_at else None,
+                'usage': self.usage.to_dict() if self.usage else None, 'memoized': self.memoized,
+                'cmd_id': self.cmd_id}
 
     def set_end(self, end_time: datetime = None):
         if end_time:
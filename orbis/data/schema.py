@@ -1,11 +1,26 @@
-from dataclasses import dataclass
+import fnmatch
+import re
+import sys
+
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from dataclasses import dataclass, field, fields
 from pathlib import Path
-from typing import List, Dict, Tuple
+from threading import RLock
+from typing import List, Dict, Tuple, Callable, Any, Iterable, Mapping
 
 import yaml
 from schema import Schema, Or, And, Use, Optional
 
 from orbis.core.exc import OrbisError
+from orbis.data.snapshot import Snapshot, content_hash
+from orbis.utils.misc import PathIndex
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 build = Schema(And({Optional('system', default=""): str, Optional('version', default=""): str,
                     Optional('arch', default=32): int, Optional('args', default=""): str,
@@ -78,10 +93,31 @@ class Location:
         return {str(self.file): self.lines}
 
 
+def _slotted(cls):
+    """
+        Recreates the dataclass with __slots__ instead of a per-instance __dict__ (dataclass(slots=True) is only
+        available from Python 3.10).
+    """
+    cls_dict = dict(cls.__dict__)
+    names = tuple(f.name for f in fields(cls))
+    cls_dict['__slots__'] = names
+
+    for name in names + ('__dict__', '__weakref__'):
+        cls_dict.pop(name, None)
+
+    return type(cls)(cls.__name__, cls.__bases__, cls_dict)
+
+
+def _intern(value: str):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+@_slotted
 @dataclass
 class Test:
     """
-        Data object represents a test case.
+        Data object represents a test case. Oracles can have tens of thousands of test cases, so the instances are
+        slotted and the strings shared between test cases (files, scripts, args) are interned.
     """
     id: str
     order: int
@@ -92,6 +128,12 @@ class Test:
     args: str = ""
     is_pov: bool = False
 
+    def __post_init__(self):
+        self.file = _intern(self.file)
+        self.cwd = _intern(self.cwd)
+        self.script = _intern(self.script)
+        self.args = _intern(self.args)
+
     def jsonify(self):
         """
             Transforms object to JSON representation.
@@ -100,6 +142,49 @@ class Test:
                 'args': self.args, "timeout": self.timeout, 'is_pov': self.is_pov}
 
 
+class Cases(MutableMapping):
+    """
+        View over the test cases of an oracle, restricted to a selection of ids. Replacing a test case in the view does not
+        change the underlying test cases.
+    """
+    __slots__ = ('_cases', '_ids', '_replaced')
+
+    def __init__(self, cases: Mapping[str, Test], ids: Iterable[str] = None):
+        self._cases = cases
+        self._ids = None if ids is None else dict.fromkeys(ids)
+        self._replaced = {}
+
+    def __getitem__(self, key: str) -> Test:
+        if key in self._replaced:
+            return self._replaced[key]
+
+        if self._ids is not None and key not in self._ids:
+            raise KeyError(key)
+
+        return self._cases[key]
+
+    def __setitem__(self, key: str, test: Test):
+        if key not in self:
+            raise KeyError(f"{key} is not in the view")
+
+        self._replaced[key] = test
+
+    def __delitem__(self, key: str):
+        raise TypeError("test cases can not be removed from the view")
+
+    def __contains__(self, key) -> bool:
+        return key in self._cases if self._ids is None else key in self._ids
+
+    def __iter__(self):
+        return iter(self._cases if self._ids is None else self._ids)
+
+    def __len__(self):
+        return len(self._cases if self._ids is None else self._ids)
+
+    def __repr__(self):
+        return f"Cases({len(self)} test cases)"
+
+
 @dataclass
 class Generator:
     script: str = ""
@@ -109,18 +194,80 @@ class Generator:
 @dataclass
 class Oracle:
     """
-        Data object representing the oracle.
+        Data object representing the oracle. The copies of the oracle view the test cases of the original.
     """
-    cases: Dict[str, Test]
+    cases: Mapping[str, Test]
     generator: Generator
     path: Path = None
     cwd: str = None
     script: str = ""
     args: str = ""
 
+    _orders: Dict[int, List[str]] = field(default=None, init=False, repr=False, compare=False)
+    _sorted_orders: List[int] = field(default=None, init=False, repr=False, compare=False)
+
     def __len__(self):
         return len(self.cases)
 
+    @property
+    def orders(self) -> Dict[int, List[str]]:
+        """
+            Returns the index of the test case ids by order. The index is built on first access, test cases are not
+            expected to be added or removed afterwards.
+        """
+        if self._orders is None:
+            orders = {}
+
+            for k, v in self.cases.items():
+                orders.setdefault(v.order, []).append(k)
+
+            self._sorted_orders = sorted(orders)
+            self._orders = orders
+
+        return self._orders
+
+    def _subset(self, ids: Iterable[str] = None) -> 'Oracle':
+        """
+            Returns a copy of the oracle viewing the test cases ids, sorted by their order (and their id, for the same
+            order), or all test cases.
+        """
+        if ids is not None:
+            ids = sorted(set(ids), key=lambda k: (self.cases[k].order, k))
+
+        return Oracle(cases=Cases(self.cases, ids), path=self.path, cwd=self.cwd, script=self.script, args=self.args,
+                      generator=self.generator)
+
+    def select(self, ids: Iterable[str] = None, orders: Iterable[int] = None, order_range: Tuple[int, int] = None,
+               pattern: str = None, regex: bool = False) -> 'Oracle':
+        """
+            Returns a copy of the oracle with the test cases matching any of the criteria, sorted by their order.
+
+            :param ids: set of test case ids
+            :param orders: set of test case orders
+            :param order_range: inclusive range (start, end) of test case orders
+            :param pattern: glob pattern (or regular expression, if the regex flag is set) matched against the ids
+            :param regex: flag to interpret the pattern as a regular expression
+        """
+        selected = []
+
+        if ids:
+            selected.extend(k for k in ids if k in self.cases)
+
+        if orders:
+            selected.extend(k for o in orders for k in self.orders.get(o, []))
+
+        if order_range:
+            index = self.orders
+            start = bisect_left(self._sorted_orders, order_range[0])
+            end = bisect_right(self._sorted_orders, order_range[1])
+            selected.extend(k for o in self._sorted_orders[start:end] for k in index[o])
+
+        if pattern:
+            match = re.compile(pattern if regex else fnmatch.translate(pattern)).match
+            selected.extend(k for k in self.cases if match(k))
+
+        return self._subset(selected)
+
     def copy(self, cases: List[str]):
         """
             Returns a copy of the oracle with the specified test cases. The specified cases can also be the order of the
@@ -128,22 +275,15 @@ class Oracle:
         """
 
         if not cases or len(cases) == 0:
-            return Oracle(cases=self.cases.copy(), path=self.path, cwd=self.cwd, script=self.script, args=self.args,
-                          generator=self.generator)
-        test_cases = {}
-        for k, v in self.cases.items():
-            if k in cases:
-                test_cases[k] = v
+            return self._subset()
+
+        oracle = self.select(ids=cases)
 
         # if no cases, we go try the order of the test cases
-        if not test_cases:
-            cases_order = [int(c) for c in cases if c.isdigit()]
-            for k, v in self.cases.items():
-                if v.order in cases_order:
-                    test_cases[k] = v
+        if not oracle:
+            oracle = self.select(orders=[int(c) for c in cases if c.isdigit()])
 
-        return Oracle(cases=test_cases, path=self.path, cwd=self.cwd, script=self.script, args=self.args,
-                      generator=self.generator)
+        return oracle
 
     def jsonify(self):
         """
@@ -153,6 +293,187 @@ class Oracle:
                 "script": self.script, "path": str(self.path), "args": self.args}
 
 
+class _Invalid(Exception):
+    """Raised by the fast path when the data does not match the schema."""
+
+
+# (type, default) of the optional fields of the oracles and test cases
+_TEST_OPTIONAL = {'script': (str, ""), 'cwd': (str, None), 'timeout': (int, None), 'args': (str, "")}
+_ORACLE_OPTIONAL = {'cwd': (str, None), 'path': (str, ""), 'args': (str, "")}
+_TEST_KEYS = {'order', 'file', *_TEST_OPTIONAL}
+_ORACLE_KEYS = {'cases', 'script', 'generator', *_ORACLE_OPTIONAL}
+
+
+def _check(value, _type):
+    # as in the schema library, booleans are not integers
+    if not isinstance(value, _type) or (_type is int and isinstance(value, bool)):
+        raise _Invalid()
+
+    return value
+
+
+def _parse_test(tid, case: dict, is_pov: bool) -> Test:
+    if not isinstance(tid, str) or not isinstance(case, dict) or not case.keys() <= _TEST_KEYS:
+        raise _Invalid()
+
+    fields = {'order': _check(case.get('order', None), int), 'file': _check(case.get('file', None), str)}
+
+    for key, (_type, default) in _TEST_OPTIONAL.items():
+        fields[key] = _check(case[key], _type) if key in case else default
+
+    return Test(id=tid, is_pov=is_pov, **fields)
+
+
+def _parse_oracle(data: dict, is_pov: bool) -> Oracle:
+    if not isinstance(data, dict) or not data.keys() <= _ORACLE_KEYS or not isinstance(data.get('cases', None), dict) \
+            or not data['cases']:
+        raise _Invalid()
+
+    fields = {'script': _check(data.get('script', None), str)}
+
+    for key, (_type, default) in _ORACLE_OPTIONAL.items():
+        fields[key] = _check(data[key], _type) if key in data else default
+
+    gen = data.get('generator', None)
+
+    if 'generator' in data:
+        if not isinstance(gen, dict) or gen.keys() != {'script', 'path'}:
+            raise _Invalid()
+
+        gen = Generator(script=_check(gen['script'], str), path=_check(gen['path'], str))
+
+    cases = {tid: _parse_test(tid, case, is_pov) for tid, case in data['cases'].items()}
+
+    return Oracle(cases=cases, script=fields['script'], args=fields['args'], path=Path(fields['path']),
+                  cwd=fields['cwd'], generator=gen)
+
+
+def parse_oracle(data: dict, is_pov: bool = False) -> Oracle:
+    """
+        Validates the oracle in a single pass and builds the same objects as the oracle schema. Data that does not match
+        is validated again with the schema, so the errors are the same.
+    """
+    try:
+        return _parse_oracle(data, is_pov)
+    except _Invalid:
+        return get_oracle(is_pov=is_pov).validate(data)
+
+
+def load_yaml(stream):
+    """
+        Loads the YAML stream with the libyaml based loader when available.
+    """
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def read_tests(file: Path) -> Oracle:
+    """
+        Reads the test oracle from the tests file.
+    """
+    with file.open(mode="r") as stream:
+        return parse_oracle(load_yaml(stream), is_pov=False)
+
+
+def read_povs(file: Path) -> Dict[str, Oracle]:
+    """
+        Reads the oracles from the povs file, by vulnerability id.
+    """
+    with file.open(mode="r") as stream:
+        return {vid: parse_oracle(pov, is_pov=True) for vid, pov in load_yaml(stream).items()}
+
+
+def _stamp(file: Path) -> Tuple:
+    """
+        Returns the (mtime, size) of the file, or None when it is missing.
+    """
+    try:
+        stat = file.stat()
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+
+class OracleCache:
+    """
+        LRU of the oracles read from the oracle files, bounded by the total number of test cases it holds. Entries are
+        keyed by the file's (mtime, size), so changed files are read again. When a snapshot is supplied, the oracles are
+        also kept on disk by the content of the file.
+    """
+
+    def __init__(self, max_cases: int, snapshot: Snapshot = None):
+        self.max_cases = max_cases
+        self.snapshot = snapshot
+        self.cases = 0
+        self._entries = OrderedDict()
+        self._keys: Dict[str, Tuple] = {}
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, file: Path, read: Callable[[Path], Any], size: Callable[[Any], int] = len) -> Any:
+        """
+            Returns the oracles in the file, reading them if not cached.
+
+            :param file: path to the oracle file
+            :param read: function that reads the oracles from the file
+            :param size: function that returns the number of test cases of the oracles
+        """
+        try:
+            stat = file.stat()
+            key = (str(file), stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            # not cached, the read function raises the error
+            return read(file)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+
+        oracles = self._read(file, read)
+
+        with self._lock:
+            if key not in self._entries:
+                self._pop(self._keys.get(key[0], None))
+                self._entries[key] = (oracles, size(oracles))
+                self._keys[key[0]] = key
+                self.cases += self._entries[key][1]
+
+            # the most recent entry is kept even if it alone exceeds the bound
+            while self.cases > self.max_cases and len(self._entries) > 1:
+                self._pop(next(iter(self._entries)))
+
+        return oracles
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+            self.cases = 0
+
+    def _pop(self, key: Tuple):
+        if key in self._entries:
+            _, cases = self._entries.pop(key)
+            self.cases -= cases
+
+            if self._keys.get(key[0], None) == key:
+                del self._keys[key[0]]
+
+    def _read(self, file: Path, read: Callable[[Path], Any]) -> Any:
+        if self.snapshot is None:
+            return read(file)
+
+        key = content_hash(file)
+        oracles = self.snapshot.load(str(file), key)
+
+        if oracles is None:
+            oracles = read(file)
+            self.snapshot.save(str(file), key, oracles)
+
+        return oracles
+
+
 @dataclass
 class Vulnerability:
     """
@@ -165,7 +486,23 @@ class Vulnerability:
     generic: List[str]
     cve: str = '-'
     pid: str = None
-    oracle: Oracle = None
+    _oracle: Oracle = field(default=None, init=False, repr=False, compare=False)
+    _project: 'Project' = field(default=None, init=False, repr=False, compare=False)
+    _vid: str = field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def oracle(self) -> Oracle:
+        """
+            Returns the POVs oracle, loaded from the project's povs file on first access.
+        """
+        if self._oracle is None and self._project is not None:
+            return self._project.get_povs().get(self._vid, None)
+
+        return self._oracle
+
+    @oracle.setter
+    def oracle(self, oracle: Oracle):
+        self._oracle = oracle
 
     def jsonify(self):
         """
@@ -219,24 +556,100 @@ class Project:
     modules: dict
     packages: dict
     patches: dict
-    oracle: Oracle = None
+    _versions: Dict[str, Manifest] = field(default=None, init=False, repr=False, compare=False)
+    _vulns: Dict[str, Manifest] = field(default=None, init=False, repr=False, compare=False)
+    _oracle: Oracle = field(default=None, init=False, repr=False, compare=False)
+    _povs: Dict[str, Oracle] = field(default=None, init=False, repr=False, compare=False)
+    _cache: OracleCache = field(default=None, init=False, repr=False, compare=False)
+    _stamps: Dict[str, Tuple] = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # indexes the manifests by commit sha and vulnerability id, first occurrence wins
+        self._versions = {}
+        self._vulns = {}
+        self._stamps = {}
 
-    def load_oracles(self):
-        # TODO: update this functionality
-        tests_file = self.path / 'tests.orbis.yaml'
+        for m in self.manifest:
+            self._versions.setdefault(m.commit, m)
+
+            for vid, vuln in m.vulns.items():
+                vuln.pid = self.id
+                vuln._project = self
+                vuln._vid = vid
+                self._vulns.setdefault(vid, m)
+
+    def __getstate__(self):
+        # the cache is shared by the projects of the process and is not kept with the project
+        state = self.__dict__.copy()
+        state['_cache'] = None
+
+        return state
+
+    @property
+    def tests_file(self) -> Path:
+        return self.path / 'tests.orbis.yaml'
+
+    @property
+    def povs_file(self) -> Path:
+        return self.path / 'povs.orbis.yaml'
+
+    def _changed(self, file: Path) -> bool:
+        # oracles set on the project are not stamped and are kept as they are
+        return file.name in self._stamps and self._stamps[file.name] != _stamp(file)
+
+    @property
+    def oracle(self) -> Oracle:
+        """
+            Returns the tests oracle, loaded from the tests file on first access and read again when the file changes.
+        """
+        if self._oracle is not None and not self._changed(self.tests_file):
+            return self._oracle
+
+        if self._cache is not None:
+            return self._cache.get(self.tests_file, read=read_tests)
+
+        self._stamps[self.tests_file.name] = _stamp(self.tests_file)
+        self._oracle = read_tests(self.tests_file)
+
+        return self._oracle
+
+    @oracle.setter
+    def oracle(self, oracle: Oracle):
+        self._stamps.pop(self.tests_file.name, None)
+        self._oracle = oracle
+
+    def get_povs(self) -> Dict[str, Oracle]:
+        """
+            Returns the POVs oracles by vulnerability id, loaded from the povs file on first access and read again
+            when the file changes.
+        """
+        if self._povs is not None and not self._changed(self.povs_file):
+            return self._povs
+
+        if self._cache is not None:
+            return self._cache.get(self.povs_file, read=read_povs, size=lambda povs: sum(map(len, povs.values())))
+
+        self._stamps[self.povs_file.name] = _stamp(self.povs_file)
+        self._povs = read_povs(self.povs_file)
 
-        with tests_file.open(mode="r") as stream:
-            yaml_file = yaml.safe_load(stream)
-            self.oracle = get_oracle(is_pov=False).validate(yaml_file)
+        return self._povs
 
-        povs_file = self.path / 'povs.orbis.yaml'
+    def bind_oracles(self, cache: OracleCache):
+        """
+            Loads the oracles through the cache, which may drop them when they are not used.
+        """
+        self._cache = cache
 
-        with povs_file.open(mode="r") as stream:
-            yaml_file = yaml.safe_load(stream)
-            vulns = {k: vuln for m in self.manifest for k, vuln in m.vulns.items()}
+    def load_oracles(self):
+        """
+            Loads the oracles and keeps them with the project.
+        """
+        self._stamps.update({file.name: _stamp(file) for file in [self.tests_file, self.povs_file]})
+        self._oracle = read_tests(self.tests_file)
+        self._povs = read_povs(self.povs_file)
 
-            for vid, pov in yaml_file.items():
-                vulns[vid].oracle = get_oracle(is_pov=True).validate(pov)
+        for vid in self._povs:
+            self.get_manifest(vid)
 
     def jsonify(self):
         """
@@ -256,16 +669,14 @@ class Project:
         }
 
     def get_manifest(self, vid: str):
-        for m in self.manifest:
-            if vid in m.vulns:
-                return m
+        if vid in self._vulns:
+            return self._vulns[vid]
 
         raise OrbisError(f"Manifest with vulnerability id {vid} not found")
 
     def get_version(self, sha: str):
-        for m in self.manifest:
-            if m.commit == sha:
-                return m
+        if sha in self._versions:
+            return self._versions[sha]
 
         raise OrbisError(f"Manifest with sha {sha} not found")
 
@@ -285,36 +696,50 @@ class Project:
         :param replace_ext: Tuple with a pair (old, new) of extensions. Replaces old with new for the comparison.
         :param skip_ext: List of extensions to skip files with the particular extension.
         :return: Dictionary with vulnerable files matched by the name with the provided files (vuln_file, match_file).
-                The comparison considers the relative path to the working directory.
+                The comparison considers the relative path to the working directory: the first supplied file ending
+                with it is matched.
         """
 
         mapping = {}
+        index = PathIndex(files)
 
-        for short_path in self.vuln_files:
-            if skip_ext and short_path.suffix in skip_ext:
+        for path in self.vuln_files:
+            if skip_ext and path.suffix in skip_ext:
                 continue
-            short_path = str(short_path)
-            if replace_ext:
-                short_path = short_path.replace(replace_ext[0], replace_ext[1])
 
-            for file, int_file in files:
-                if short_path in file:
-                    if replace_ext:
-                        short_path = short_path.replace(replace_ext[1], replace_ext[0])
-                    mapping[short_path] = int_file
-                    break
+            short_path = str(path)
+            lookup = short_path
+
+            if replace_ext and lookup.endswith(replace_ext[0]):
+                lookup = lookup[:-len(replace_ext[0])] + replace_ext[1]
+
+            match = index.find(lookup)
+
+            if match:
+                mapping[short_path] = match[1]
 
         return mapping
 
 
+project = Schema({'id': str, 'name': str, 'manifest': manifest, 'build': build,
+                  Optional('patches', default={}): dict, Optional('modules', default={}): dict,
+                  Optional('packages', default={}): dict})
+
+
+def parse_project(repo_path: str, entry: dict, corpus_path: Path) -> Project:
+    """
+        Returns the project for a single entry in the metadata file.
+    """
+    proj = project.validate(entry)
+
+    return Project(repo_path=repo_path, id=proj['id'], name=proj['name'], path=corpus_path / proj['name'],
+                   build=proj['build'], manifest=proj['manifest'], modules=proj['modules'],
+                   packages=proj['packages'], patches=proj['patches'])
+
+
 def parse_dataset(yaml_file: dict, corpus_path: Path) -> List[Project]:
     """
         Returns the projects in the metadata file.
     """
-    return Schema(And({str: {'id': str, 'name': str, 'manifest': manifest, 'build': build,
-                             Optional('patches', default={}): dict, Optional('modules', default={}): dict,
-                             Optional('packages', default={}): dict}},
-                      Use(lambda proj: [Project(repo_path=k, id=v['id'], name=v['name'], path=corpus_path / v['name'],
-                                                build=v['build'], manifest=v['manifest'], modules=v['modules'],
-                                                packages=v['packages'], patches=v['patches'])
-                                        for k, v in proj.items()]))).validate(yaml_file)
+    return Schema(And({str: dict}, Use(lambda proj: [parse_project(k, v, corpus_path=corpus_path)
+                                                     for k, v in proj.items()]))).validate(yaml_file)
@@ -0,0 +1,78 @@
+import hashlib
+import os
+import pickle
+
+from pathlib import Path
+from typing import Any, Union
+
+from orbis.core.version import get_version
+
+# bump when the layout of the data objects changes to invalidate the existing snapshots
+SNAPSHOT_FORMAT = 3
+
+
+def content_hash(*parts: Union[str, bytes, Path]) -> str:
+    """
+        Returns the digest of the parts. Paths are hashed by their content, missing files by their name.
+    """
+    digest = hashlib.sha256(f"{get_version()}:{SNAPSHOT_FORMAT}".encode())
+
+    for part in parts:
+        if isinstance(part, Path):
+            try:
+                with part.open(mode="rb") as stream:
+                    for chunk in iter(lambda: stream.read(1 << 20), b''):
+                        digest.update(chunk)
+            except OSError:
+                digest.update(f"missing:{part}".encode())
+        elif isinstance(part, str):
+            digest.update(part.encode())
+        else:
+            digest.update(part)
+
+        digest.update(b'\0')
+
+    return digest.hexdigest()
+
+
+class Snapshot:
+    """
+        On-disk store of compiled (validated) data objects. Each entry is kept under a name with the content key it was
+        compiled from, so it is only returned while the key matches and is overwritten when it does not.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def _file(self, name: str) -> Path:
+        return self.path / f"{hashlib.sha1(name.encode()).hexdigest()}.pickle"
+
+    def load(self, name: str, key: str) -> Any:
+        """
+            Returns the object stored under the name if it was compiled from the same key, otherwise None.
+        """
+        try:
+            with self._file(name).open(mode="rb") as stream:
+                stored_key, obj = pickle.load(stream)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, ValueError, TypeError):
+            return None
+
+        return obj if stored_key == key else None
+
+    def save(self, name: str, key: str, obj: Any):
+        """
+            Stores the object under the name. The file is replaced atomically to be safe for concurrent runs.
+        """
+        file = self._file(name)
+        tmp_file = file.with_suffix(f".{os.getpid()}.tmp")
+
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+
+            with tmp_file.open(mode="wb") as stream:
+                pickle.dump((key, obj), stream, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.replace(str(tmp_file), str(file))
+        except OSError:
+            if tmp_file.exists():
+                tmp_file.unlink()
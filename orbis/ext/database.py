@@ -1,23 +1,56 @@
 import contextlib
 import subprocess
+import time
 from pathlib import Path
-from typing import Any, Callable, Dict, Union
+from threading import Lock
+from typing import Any, Callable, Dict, Union, List, Optional
 
 from cement import Handler
 from sqlalchemy import create_engine
 from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import inspect
+from sqlalchemy import inspect, text, func, case, or_
 
-from sqlalchemy import Column, Integer, String, Boolean, Float, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, Float, ForeignKey
 from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.pool import QueuePool
 from sqlalchemy_utils import create_database, database_exists
 
 from orbis.core.interfaces import HandlersInterface, DatabaseInterface
+from orbis.data.history import TestHistory, TestStats
+from orbis.data.results import Usage
 
 Base = declarative_base()
+# bump when columns are added to the existing tables, to migrate the databases of older versions
+SCHEMA_VERSION = 3
 
 
-class TestOutcome(Base):
+class ResourceUsage:
+    """
+        Columns for the resources used by the command of an outcome.
+    """
+    user_time = Column('user_time', Float, nullable=True)
+    sys_time = Column('sys_time', Float, nullable=True)
+    max_rss = Column('max_rss', Integer, nullable=True)
+    vol_ctx_switches = Column('vol_ctx_switches', Integer, nullable=True)
+    invol_ctx_switches = Column('invol_ctx_switches', Integer, nullable=True)
+    read_bytes = Column('read_bytes', BigInteger, nullable=True)
+    write_bytes = Column('write_bytes', BigInteger, nullable=True)
+    memory_peak = Column('memory_peak', BigInteger, nullable=True)
+    oom_kills = Column('oom_kills', Integer, nullable=True)
+
+    def set_usage(self, usage: Usage):
+        if usage:
+            for key, value in usage.to_dict().items():
+                setattr(self, key, value)
+
+    def usage_dict(self):
+        return {'user_time': self.user_time, 'sys_time': self.sys_time, 'max_rss': self.max_rss,
+                'vol_ctx_switches': self.vol_ctx_switches, 'invol_ctx_switches': self.invol_ctx_switches,
+                'read_bytes': self.read_bytes, 'write_bytes': self.write_bytes, 'memory_peak': self.memory_peak,
+                'oom_kills': self.oom_kills}
+
+
+class TestOutcome(ResourceUsage, Base):
     __tablename__ = "test_outcome"
 
     id = Column('id', Integer, primary_key=True)
@@ -34,6 +67,17 @@ class TestOutcome(Base):
     exit_status = Column('exit_status', Integer, nullable=False)
     sig = Column('sig', Integer, nullable=True)
     duration = Column('duration', Float, nullable=False)
+    fingerprint = Column('fingerprint', String, nullable=True, index=True)
+    confidence = Column('confidence', Float, nullable=True)
+    # replayed from an outcome with the same fingerprint, rather than run
+    cached = Column('cached', Boolean, nullable=True)
+
+    @property
+    def skipped(self) -> bool:
+        """
+            Whether the test case was not run (e.g., after a failure with fail fast), in which case it did not pass.
+        """
+        return not self.passed and self.msg == "Test skipped"
 
     def get_clean_error(self):
         return self.error.strip().replace('\n', ' ') if self.error else ''
@@ -45,15 +89,17 @@ class TestOutcome(Base):
     def to_dict(self):
         return {'id': self.id, 'compile id': self.co_id, 'name': self.name, 'is pov': self.is_pov, 'order': self.order,
                 'passed': self.passed, 'error': self.get_clean_error(), 'exit_status': self.exit_status,
-                'signal': self.sig, 'duration': self.duration}
+                'signal': self.sig, 'duration': self.duration, 'confidence': self.confidence, 'cached': self.cached,
+                **self.usage_dict()}
 
     def jsonify(self):
         return {'id': self.id, 'name': self.name, 'is pov': self.is_pov, 'passed': self.passed, 'compile id': self.co_id,
                 'error': self.get_clean_error(), 'exit_status': self.exit_status, 'signal': self.sig, 'msg': self.msg,
-                'duration': self.duration, 'order': self.order,}
+                'duration': self.duration, 'order': self.order, 'confidence': self.confidence, 'cached': self.cached,
+                **self.usage_dict()}
 
 
-class CompileOutcome(Base):
+class CompileOutcome(ResourceUsage, Base):
     __tablename__ = "compile_outcome"
 
     id = Column('id', Integer, primary_key=True)
@@ -63,13 +109,16 @@ class CompileOutcome(Base):
     error = Column('error', String, nullable=True)
     tag = Column('tag', String, nullable=False)
     exit_status = Column('exit_status', Integer)
+    # digest of the args of the build, the test outcomes are reused across the builds with the same flags
+    flags = Column('flags', String, nullable=True)
 
     def __str__(self):
         clean_error = self.error.strip().replace('\n', ' ') if self.error else ''
         return f"{self.id} | {clean_error} | {self.tag} | {self.exit_status}"
 
     def jsonify(self):
-        return {'id': self.id, 'error': self.error, 'tag': self.tag, 'exit_status': self.exit_status}
+        return {'id': self.id, 'error': self.error, 'tag': self.tag, 'exit_status': self.exit_status,
+                **self.usage_dict()}
 
 
 class Instance(Base):
@@ -90,6 +139,12 @@ class Instance(Base):
         return f"{self.id} | {self.m_id} | {self.name} | {self.path} | {self.pointer}"
 
 
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    version = Column('version', Integer, primary_key=True)
+
+
 class InstanceHandler(DatabaseInterface, Handler):
     class Meta:
         label = 'instance'
@@ -127,6 +182,56 @@ class Database:
 
         self.engine = create_engine(self.url, echo=debug)
         Base.metadata.create_all(bind=self.engine)
+        self.migrate()
+
+    def get_pool_limit(self) -> Optional[int]:
+        """
+            Returns the number of connections the pool of the engine can open at once (the pool size plus the
+            overflow), or None when it is not bounded.
+        """
+        pool = self.engine.pool
+
+        if not isinstance(pool, QueuePool):
+            return None
+
+        overflow = getattr(pool, '_max_overflow', 0)
+
+        return None if overflow < 0 else pool.size() + overflow
+
+    def migrate(self):
+        """
+            Brings the tables of a database created by an older version up to the current schema version, once.
+        """
+        with Session(self.engine) as session, session.begin():
+            version = session.query(func.max(SchemaVersion.version)).scalar() or 0
+
+        if version >= SCHEMA_VERSION:
+            return
+
+        self.add_missing_columns()
+
+        with Session(self.engine) as session, session.begin():
+            session.query(SchemaVersion).delete()
+            session.add(SchemaVersion(version=SCHEMA_VERSION))
+
+    def add_missing_columns(self):
+        """
+            Adds to the existing tables the nullable columns introduced after they were created.
+        """
+        inspector = inspect(self.engine)
+
+        with self.engine.begin() as con:
+            for table in Base.metadata.sorted_tables:
+                existing = {column['name'] for column in inspector.get_columns(table.name)}
+
+                for column in table.columns:
+                    if column.name not in existing and column.nullable:
+                        col_type = column.type.compile(dialect=self.engine.dialect)
+                        con.execute(text(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {col_type}'))
+
+                        for index in table.indexes:
+                            if column in index.columns.values():
+                                index.create(bind=con, checkfirst=True)
 
     def refresh(self, entity: Base):
         with Session(self.engine) as session, session.begin():
@@ -135,15 +240,26 @@ class Database:
         return entity
 
     def add(self, entity: Base):
-        with Session(self.engine) as session, session.begin():
+        # the id is returned by the insert, the entity is not expired to avoid selecting it again
+        with Session(self.engine, expire_on_commit=False) as session, session.begin():
             session.add(entity)
             session.flush()
-            session.refresh(entity)
             session.expunge_all()
 
             if hasattr(entity, 'id'):
                 return entity.id
 
+    def add_all(self, entities: List[Base]) -> List[int]:
+        """
+            Inserts the entities in a single transaction, batching the inserts of the same table. Returns their ids.
+        """
+        with Session(self.engine, expire_on_commit=False) as session, session.begin():
+            session.add_all(entities)
+            session.flush()
+            session.expunge_all()
+
+            return [getattr(entity, 'id', None) for entity in entities]
+
     def destroy(self):
         # metadata = MetaData(self.engine, reflect=True)
         with contextlib.closing(self.engine.connect()) as con:
@@ -175,6 +291,18 @@ class Database:
 
             return query
 
+    def iterate(self, entity: Base, batch_size: int = 100):
+        """
+            Yields the rows of the entity, fetched from a server-side cursor in batches. The session is kept open until
+            the generator is exhausted or closed, and the rows are detached as they are yielded.
+        """
+        with Session(self.engine) as session, session.begin():
+            query = session.query(entity).execution_options(stream_results=True).yield_per(batch_size)
+
+            for row in query:
+                session.expunge(row)
+                yield row
+
     def query_attr(self, entity: Base, entity_id: int, attr: str):
         with Session(self.engine) as session, session.begin():
             if hasattr(entity, 'id') and hasattr(entity, attr):
@@ -194,6 +322,79 @@ class Database:
             session.expunge_all()
             return query
 
+    def test_history(self, pid: str, percentile: float = None) -> TestHistory:
+        """
+            Returns the stats of the test outcomes of the instances of the project, leaving out the replayed outcomes.
+
+            :param pid: the id of the project
+            :param percentile: loads the percentile (nearest rank) of the durations of the runs that did not time out as
+                            well, computed by the database
+        """
+        stats, total = {}, {}
+        # the replayed outcomes would count the same run again
+        ran = or_(TestOutcome.cached.is_(None), TestOutcome.cached.is_(False))
+
+        with Session(self.engine) as session, session.begin():
+            # grouped by build as well, to find the tests that passed and failed on the same build of an instance
+            # the povs and the tests are apart, as they can have the same names
+            rows = session.query(TestOutcome.name, TestOutcome.is_pov, func.count(TestOutcome.id),
+                                 func.sum(case((TestOutcome.passed.is_(False), 1), else_=0)),
+                                 func.sum(TestOutcome.duration)) \
+                .join(Instance, TestOutcome.instance_id == Instance.id) \
+                .filter(Instance.pid == pid, ran) \
+                .group_by(TestOutcome.name, TestOutcome.is_pov, TestOutcome.co_id)
+
+            for name, is_pov, runs, failures, duration in rows:
+                key = (name, bool(is_pov))
+                test_stats = stats.setdefault(key, TestStats(name=name, is_pov=bool(is_pov)))
+                failures = int(failures or 0)
+                test_stats.runs += runs
+                test_stats.failures += failures
+                test_stats.builds += 1
+                test_stats.mixed += 1 if 0 < failures < runs else 0
+                total[key] = total.get(key, 0) + float(duration or 0)
+
+            if percentile is not None:
+                for name, is_pov, runs, duration in self._percentile_durations(session, pid, ran, percentile):
+                    test_stats = stats[(name, bool(is_pov))]
+                    test_stats.timed_runs, test_stats.percentile_duration = int(runs), float(duration)
+
+        for key, test_stats in stats.items():
+            test_stats.duration = total[key] / test_stats.runs if test_stats.runs else 0
+
+        return TestHistory(stats=stats)
+
+    @staticmethod
+    def _percentile_durations(session: Session, pid: str, ran, percentile: float):
+        """
+            Returns the number of durations of the runs of each test case that did not time out and their percentile,
+            the first duration (in order) with a rank of at least the percentile of the runs, i.e., the nearest rank.
+        """
+        partition = [TestOutcome.name, TestOutcome.is_pov]
+        ranked = session.query(TestOutcome.name, TestOutcome.is_pov, TestOutcome.duration,
+                               func.row_number().over(partition_by=partition,
+                                                      order_by=TestOutcome.duration).label('duration_rank'),
+                               func.count(TestOutcome.id).over(partition_by=partition).label('runs')) \
+            .join(Instance, TestOutcome.instance_id == Instance.id) \
+            .filter(Instance.pid == pid, ran) \
+            .filter(or_(TestOutcome.error.is_(None), TestOutcome.error != "Test timed out")) \
+            .subquery()
+
+        return session.query(ranked.c.name, ranked.c.is_pov, func.max(ranked.c.runs), func.min(ranked.c.duration)) \
+            .filter(ranked.c.duration_rank * 100 >= ranked.c.runs * percentile) \
+            .group_by(ranked.c.name, ranked.c.is_pov)
+
+    def find_outcome(self, fingerprint: str) -> Optional[TestOutcome]:
+        """
+            Returns the latest test outcome with the fingerprint, if any.
+        """
+        with Session(self.engine) as session, session.begin():
+            outcome = session.query(TestOutcome).filter(TestOutcome.fingerprint == fingerprint) \
+                .order_by(TestOutcome.id.desc()).first()
+            session.expunge_all()
+
+            return outcome
+
     def count(self, entity: Base):
         with Session(self.engine) as session, session.begin():
             return session.query(entity).count()
@@ -206,6 +407,77 @@ class Database:
                 raise ValueError(f"Could not update {type(entity)} {attr} with value {value}")
 
 
+class OutcomeWriter:
+    """
+        Buffers the outcomes to insert them in batches, when the buffer is full, when an outcome is added after the
+        oldest one waited for the interval, or when flushed. The ids are set on the outcomes when they are inserted.
+        The flushes run in the threads adding the outcomes, the ones left in the buffer are inserted by the last flush.
+    """
+
+    def __init__(self, db: Database, batch_size: int = 500, interval: float = 1, log: Callable[[str], None] = None):
+        self.db = db
+        self.batch_size = batch_size
+        self.interval = interval
+        self.log = log
+        self._buffer: List[Base] = []
+        self._lock = Lock()
+        # when the oldest buffered entity was added
+        self._since: float = None
+
+    def add(self, entity: Base, flush: bool = False) -> Optional[int]:
+        """
+            Buffers the entity. Returns its id if it was inserted, i.e., with the flush flag, when the buffer is full or
+            when the interval has passed. A failing flush for the interval is logged, and retried with the next flush.
+        """
+        with self._lock:
+            if not self._buffer:
+                self._since = time.monotonic()
+
+            self._buffer.append(entity)
+            full = len(self._buffer) >= self.batch_size
+            due = bool(self.interval) and time.monotonic() - self._since >= self.interval
+
+        if flush or full:
+            self.flush()
+        elif due:
+            try:
+                self.flush()
+            except Exception as e:
+                if self.log:
+                    self.log(f"Failed to insert {len(self)} buffered outcomes: {e}")
+
+        return getattr(entity, 'id', None)
+
+    def flush(self) -> List[int]:
+        """
+            Inserts the buffered entities and returns their ids. On failure, the entities are kept for the next flush.
+        """
+        with self._lock:
+            entities, self._buffer = self._buffer, []
+            since, self._since = self._since, None
+
+        if not entities:
+            return []
+
+        try:
+            return self.db.add_all(entities)
+        except Exception:
+            with self._lock:
+                self._buffer = entities + self._buffer
+                self._since = since
+
+            raise
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+
 def exec_cmd(app, cmd: str, msg: str):
     with subprocess.Popen(args=cmd, shell=True, stdout=subprocess.PIPE,
                           stderr=subprocess.PIPE) as proc:
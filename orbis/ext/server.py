@@ -1,18 +1,22 @@
 """
     REST API extension
 """
+import json
 import re
+from dataclasses import replace
 from inspect import signature
 from pathlib import Path
-from typing import List, Callable
+from typing import List, Callable, Iterable, Tuple, Any, Optional
 from pydoc import locate
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from sqlalchemy.exc import SQLAlchemyError
 # from flask_marshmallow import Marshmallow
 from orbis.controllers.base import VERSION_BANNER
 from orbis.core.exc import OrbisError, CommandError, OrbisError400
 from orbis.data.results import CommandData
 from orbis.ext.database import Instance
 from orbis.handlers.benchmark.java_benchmark import JavaBenchmark
+from orbis.utils.broker import get_broker, streaming
 
 
 def has_param(data, key: str):
@@ -38,8 +42,119 @@ def replace_tests_name(replace_fmt, tests: List[str]) -> List[str]:
         raise OrbisError400("'replace_fmt' must be a list of two strings.")
 
     pattern, repl = replace_fmt
+    regex = re.compile(pattern)
 
-    return [re.sub(pattern, repl, t) for t in tests]
+    return [regex.sub(repl, t) for t in tests]
+
+
+def wants_ndjson() -> bool:
+    """
+        Checks if the client asked for newline-delimited JSON, with the 'format' query arg or the Accept header.
+    """
+    return request.args.get('format', None) == 'ndjson' or \
+        request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+
+def stream_json(items: Iterable[Tuple[Any, Callable[[], dict]]], ndjson: bool = False,
+                log: Callable[[str], Any] = None) -> Response:
+    """
+        Streams the items as a JSON object (or an object per line, for NDJSON) while they are serialized. The first
+        item is fetched before the response starts, so that the errors of the query are raised to the caller. The
+        object of the items is wrapped in an envelope, {"items": {...}}, and the errors raised while streaming are
+        added to it under "error", apart from the ids and keeping the JSON valid. In NDJSON mode, the error is sent as
+        a trailing {"error": ...} record, with a string instead of the object of an item.
+
+        :param items: pairs of key and function returning the JSON representation of the value
+        :param ndjson: flag to stream newline-delimited JSON
+        :param log: function logging the errors raised while streaming
+    """
+    items = iter(items)
+    first = next(items, None)
+
+    def entries():
+        if first is not None:
+            yield first
+            yield from items
+
+    def dump(entry: dict, sep: bool) -> str:
+        # entries of the JSON object are written without their braces
+        return json.dumps(entry) + '\n' if ndjson else f"{',' if sep else ''}{json.dumps(entry)[1:-1]}"
+
+    def generate():
+        count = 0
+        error = None
+
+        if not ndjson:
+            yield '{"items": {'
+
+        try:
+            for key, value in entries():
+                yield dump({str(key): value()}, sep=count > 0)
+                count += 1
+        except Exception as e:
+            if log:
+                log(f"Streaming stopped after {count} entries: {e}")
+
+            error = str(e)
+
+        if not ndjson:
+            yield '}'
+
+        if error is not None:
+            yield dump({'error': error}, sep=not ndjson)
+
+        if not ndjson:
+            yield '}'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+
+def stream_events(channel: str, ndjson: bool = False, keep_alive: float = 15) -> Optional[Response]:
+    """
+        Streams the events published to the channel as server-sent events (or NDJSON) until the client disconnects, or
+        the command ends for command channels. Events the client does not keep up with are dropped and reported.
+        Returns None for the channel of a command that is not running.
+    """
+    broker = get_broker()
+    subscription = broker.subscribe(channel)
+    cmd_id = channel.split(':', 1)[1] if channel.startswith('command:') else None
+
+    # checked after subscribing, the end of the command is either published to the subscription or already done
+    if cmd_id is not None and not broker.is_live(channel):
+        broker.unsubscribe(subscription)
+        return None
+
+    def format_event(event: dict) -> str:
+        if ndjson:
+            return json.dumps(event) + '\n'
+
+        return f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+
+    def generate():
+        try:
+            while True:
+                events, dropped = subscription.get(timeout=keep_alive)
+
+                if dropped:
+                    yield format_event({'event': 'dropped', 'count': dropped})
+
+                if not events:
+                    if cmd_id is not None and not broker.is_live(channel):
+                        return
+
+                    # also detects the disconnected clients
+                    yield '\n' if ndjson else ': keep-alive\n\n'
+
+                for event in events:
+                    yield format_event(event)
+
+                    if cmd_id is not None and event['event'] == 'end' and event['id'] == cmd_id:
+                        return
+        finally:
+            broker.unsubscribe(subscription)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson' if ndjson else 'text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 def get_method_parameters(method: Callable, replace: dict, drop: list, insert: dict):
@@ -161,7 +276,10 @@ def setup_api(app):
                 try:
                     response = {}
                     benchmark_handler.set(project=context.project, **set_args)
-                    cmd_data = benchmark_handler.build(context=context, **kwargs)
+
+                    with streaming(f"instance:{context.instance.id}"):
+                        cmd_data = benchmark_handler.build(context=context, **kwargs)
+
                     response.update(cmd_data.to_dict())
                     return jsonify(response)
                 except (CommandError, OrbisError) as e:
@@ -170,7 +288,7 @@ def setup_api(app):
                     return {"error": "cmd_data.error"}, 500
                 finally:
                     benchmark_handler.unset()
-                    benchmark_handler.build_handler.save_outcome(cmd_data, context)
+                    benchmark_handler.build_handler.save_outcome(cmd_data, context, args=kwargs)
             except OrbisError as oe:
                 app.log.debug(str(oe))
                 return {"error": str(oe)}, 500
@@ -225,8 +343,7 @@ def setup_api(app):
                 if "replace_neg_fmt" in kwargs:
                     request_tests = replace_tests_name(replace_fmt=kwargs["replace_neg_fmt"], tests=request_tests)
 
-                request_tests.sort()
-                # Get tests
+                # Get tests (the selected tests follow the order in the oracle)
                 tests = context.project.oracle.copy(request_tests)
 
                 # If no tests, get povs
@@ -242,15 +359,21 @@ def setup_api(app):
                 del kwargs['tests']
 
                 # If test has timeout, add the test margin timeout for the benchmark
-                for tn, tc in tests.cases.items():
+                # (tests are replaced rather than updated, as the cases are shared with the catalog)
+                for tn, tc in list(tests.cases.items()):
                     if tc.timeout is not None:
-                        tc.timeout += benchmark_handler.get_test_timeout_margin(tc.timeout)
+                        tests.cases[tn] = replace(tc, timeout=tc.timeout +
+                                                  benchmark_handler.get_test_timeout_margin(tc.timeout))
 
                 cmd_data = CommandData.get_blank()
 
                 try:
                     app.log.info(f"Running {len(tests)} tests.")
-                    tests_outcome = benchmark_handler.test(context=context, tests=tests, timeout=timeout, **kwargs)
+
+                    with streaming(f"instance:{context.instance.id}"):
+                        tests_outcome = benchmark_handler.test(context=context, tests=tests, timeout=timeout,
+                                                               **kwargs)
+
                     # TODO: fix this quick fix
                     app.log.debug(str(tests_outcome[0].to_dict()))
                     return jsonify([t.to_dict() for t in tests_outcome])
@@ -292,8 +415,10 @@ def setup_api(app):
                     if batch_type != 'all':
                         batch_type = 'povs'
                     if isinstance(benchmark_handler, JavaBenchmark):
-                        cmd_data = benchmark_handler.test_batch(context=context, batch_type=batch_type,
-                                                                timeout=timeout, **kwargs)
+                        with streaming(f"instance:{context.instance.id}"):
+                            cmd_data = benchmark_handler.test_batch(context=context, batch_type=batch_type,
+                                                                    timeout=timeout, **kwargs)
+
                         response.update(cmd_data.to_dict())
                         response["passed"] = len(cmd_data["test_results"]["failing_tests"]) == 0
                         return jsonify(response)
@@ -384,6 +509,22 @@ def setup_api(app):
 
         return {"error": "Request must be JSON"}, 415
 
+    @api.route('/stream/<kind>/<key>', methods=['GET'])
+    def stream(kind, key):
+        """
+            Streams the output of the commands of an instance (/stream/instance/<iid>) or of a running command
+            (/stream/command/<id>, with the id of its events) while they run.
+        """
+        if kind not in ['instance', 'command']:
+            return {'error': f"Can not stream '{kind}' {key}, must be 'instance' or 'command' (with its id)."}, 400
+
+        response = stream_events(f"{kind}:{key}", ndjson=wants_ndjson())
+
+        if response is None:
+            return {'error': f"Command {key} is not running."}, 404
+
+        return response
+
     @api.route('/manifest/<pid>', methods=['GET'])
     def manifest(pid):
         try:
@@ -406,7 +547,9 @@ def setup_api(app):
     def projects():
         try:
             benchmark_handler = app.handler.get('handlers', app.plugin.benchmark, setup=True)
-            return {k: v for p in benchmark_handler.get_projects() for k, v in p.jsonify().items()}
+            # each project is serialized when it is streamed
+            return stream_json(((p.id, lambda p=p: p.jsonify()[p.id]) for p in benchmark_handler.get_projects()),
+                               ndjson=wants_ndjson())
         except OrbisError as oe:
             app.log.error(str(oe))
             return {}
@@ -414,14 +557,14 @@ def setup_api(app):
     @api.route('/instances', methods=['GET'])
     def instances():
         try:
-            res = app.db.query(Instance)
-
-            if res:
-                return {i.id: i.to_dict() for i in res}
-            return {}
+            return stream_json(((i.id, i.to_dict) for i in app.db.iterate(Instance)), ndjson=wants_ndjson(),
+                               log=app.log.error)
         except OrbisError as oe:
             app.log.error(str(oe))
             return {}
+        except SQLAlchemyError as se:
+            app.log.error(str(se))
+            return {'error': str(se)}, 500
 
     @api.route('/instance/<iid>', methods=['GET'])
     def instance(iid):
@@ -455,7 +598,8 @@ def setup_api(app):
     def vulns():
         try:
             benchmark_handler = app.handler.get('handlers', app.plugin.benchmark, setup=True)
-            return {vid: vul.jsonify() for vid, vul in benchmark_handler.get_vulns().items()}
+            return stream_json(((vid, vul.jsonify) for vid, vul in benchmark_handler.get_vulns().items()),
+                               ndjson=wants_ndjson())
         except OrbisError as oe:
             app.log.error(str(oe))
             return {}
@@ -1,18 +1,23 @@
 from abc import abstractmethod
-from os import environ
 from pathlib import Path
+from threading import Lock
 from typing import List, Dict
 
 from cement import Handler
 
 from orbis.core.exc import OrbisError
+from orbis.data.catalog import Catalog, CatalogIndex
+from orbis.data.env import EnvOverlay
 from orbis.data.misc import Context
 from orbis.data.results import CommandData
-from orbis.data.schema import Project, Oracle, parse_dataset, Vulnerability
+from orbis.data.schema import Project, Oracle, Vulnerability, OracleCache
+from orbis.data.snapshot import Snapshot
 from orbis.ext.database import Instance
 from orbis.handlers.command import CommandHandler
 from orbis.handlers.operations.checkout import CheckoutHandler
 
+_catalog_lock = Lock()
+
 
 def args_to_str(args: dict) -> str:
     arg_str = ""
@@ -32,16 +37,26 @@ class BenchmarkHandler(CommandHandler):
 
     def __init__(self, **kw):
         super().__init__(**kw)
-        self.env = environ.copy()
+        self.env = EnvOverlay()
 
     @abstractmethod
     def set(self, **kwargs):
-        """Sets the env variables for the operations."""
+        """Sets the env variables for the operations, which the commands get through get_env."""
         pass
 
     def unset(self):
         """Unsets the env variables."""
-        self.env = environ.copy()
+        self.env = EnvOverlay()
+
+    def get_env(self, project: Project = None, **variables) -> EnvOverlay:
+        """
+            Returns an overlay of the env variables of the handler with the build env of the project and the variables
+            supplied, for the commands of the operations. The variables of the handler are copied, so that the commands
+            are not affected by later calls to set or unset, and the commands do not change the env of the handler.
+        """
+        env = self.env.copy().child(project.build.env if project and project.build.env else None)
+
+        return env.child(variables) if variables else env
 
     #    def __call__(self, cmd_str, args: dict = None, call: bool = True, **kwargs) -> CommandData:
     #        cmd_data = CommandData(f"{cmd_str} {args_to_str(args)}" if args else cmd_str)
@@ -64,68 +79,79 @@ class BenchmarkHandler(CommandHandler):
 
     def get_configs(self):
         return self.app.config.get_section_dict(self.Meta.label).copy()
-    
+
+    @property
+    def catalog(self) -> Catalog:
+        """
+            Returns the catalog of the dataset, shared by the handlers during the lifetime of the application.
+        """
+        with _catalog_lock:
+            if not hasattr(self.app, 'catalog'):
+                cache_dir = self.app.get_config('cache_dir')
+                cache_size = self.app.get_config('oracle_cache_size')
+                snapshot, oracles = None, None
+
+                if cache_dir:
+                    snapshot = Snapshot(Path(cache_dir).expanduser() / 'dataset')
+
+                if cache_size:
+                    oracles = OracleCache(max_cases=cache_size,
+                                          snapshot=Snapshot(Path(cache_dir).expanduser() / 'oracles') if cache_dir
+                                          else None)
+
+                self.app.extend('catalog', Catalog(corpus_path=Path(self.get_config('corpus')), snapshot=snapshot,
+                                                   oracles=oracles))
+
+        return self.app.catalog
+
     def get_projects(self, load: bool = True) -> List[Project]:
         """
             Returns the projects in the dataset
         """
-        dataset = self.get_config('dataset')
-        corpus_path = Path(self.get_config('corpus'))
-        projects = parse_dataset(dataset, corpus_path=corpus_path)
+        return self.catalog.get_projects(self.get_config('dataset'), load=load)
 
-        if load:
-            for project in projects:
-                project.load_oracles()
-
-        return projects
+    def get_index(self, load: bool = True) -> CatalogIndex:
+        """
+            Returns the lookup tables for the projects in the dataset
+        """
+        return self.catalog.get_index(self.get_config('dataset'), load=load)
 
     def get_vulns(self) -> Dict[str, Vulnerability]:
         """
             Returns the vulnerabilities in the dataset
         """
-        vulns = {}
-
-        for p in self.get_projects():
-            for m in p.manifest:
-                for k, vuln in m.vulns.items():
-                    vuln.pid = p.id
-                    vulns[k] = vuln
-
-        return vulns
+        return {vid: vuln for vid, (_, _, vuln) in self.get_index().vulns.items()}
 
     def get_vuln(self, vid: str) -> Vulnerability:
-        for project in self.get_projects():
-            for m in project.manifest:
-                for k, vuln in m.vulns.items():
-                    if k == vid:
-                        vuln.pid = project.id
-                        return vuln
+        entry = self.get_index().vulns.get(vid, None)
+
+        if entry:
+            return entry[2]
 
     def get_by_vid(self, vid: str) -> Project:
-        for project in self.get_projects():
-            for m in project.manifest:
-                for k, vuln in m.vulns.items():
-                    if k == vid:
-                        return project
+        entry = self.get_index().vulns.get(vid, None)
+
+        if entry:
+            return entry[0]
 
         raise OrbisError(f"Project with vulnerability id {vid} not found")
 
     def get_by_commit_sha(self, commit_sha: str) -> Project:
-        for project in self.get_projects():
-            for m in project.manifest:
-                if m.commit == commit_sha:
-                    return project
+        entry = self.get_index().commits.get(commit_sha, None)
+
+        if entry:
+            return entry[0]
 
         raise OrbisError(f"Project with commit sha {commit_sha} not found")
 
     def has(self, pid: str) -> bool:
-        return pid in [p.id for p in self.get_projects()]
+        return pid in self.get_index(load=False).projects
 
     def get(self, pid: str) -> Project:
-        for p in self.get_projects():
+        project = self.get_index().projects.get(pid, None)
 
-            if p.id == pid:
-                return p
+        if project:
+            return project
 
         raise OrbisError(f"Program with {pid} not found")
 
@@ -1,7 +1,9 @@
 from abc import abstractmethod, ABC
+from typing import List, Tuple
 
 from orbis.data.misc import Context
 from orbis.data.results import CommandData
+from orbis.ext.database import TestOutcome
 from orbis.data.schema import Oracle, Project
 from orbis.handlers.benchmark.benchmark import BenchmarkHandler
 from orbis.handlers.operations.c.build import BuildHandler
@@ -38,6 +40,16 @@ class CBenchmark(BenchmarkHandler, ABC):
              **kwargs) -> CommandData:
         pass
 
+    def run_tests(self, context: Context, tests: Oracle, timeout: int,
+                  **kwargs) -> List[Tuple[CommandData, TestOutcome]]:
+        """
+            Runs the test cases in parallel with the env of the benchmark and the project, for the implementations of
+            test.
+        """
+        env = self.get_env(context.project)
+
+        return self.test_handler.run_batch(context=context, tests=tests, timeout=timeout, env=env, **kwargs)
+
     @abstractmethod
     def gen_tests(self, project: Project, **kwargs) -> CommandData:
         pass
@@ -1,12 +1,27 @@
+import asyncio
+import errno
+import os
+import shutil
+import signal
 import subprocess
-import psutil as psutil
+import threading
+import uuid
 
-from threading import Timer
+from pathlib import Path
+from datetime import datetime
+from typing import Tuple, Optional, Callable, Dict, List, Union
 from cement import Handler
 
 from orbis.core.exc import CommandError
-from orbis.data.results import CommandData
+from orbis.data.env import materialize
+from orbis.data.memo import Memo, CommandCache
+from orbis.data.results import CommandData, Usage
 from orbis.core.interfaces import HandlersInterface
+from orbis.utils.broker import get_broker, stream_channels
+from orbis.utils.capture import StreamBuffer, drain, adrain
+from orbis.utils.cgroup import CGroup, CGroupLimits, delegated_root
+from orbis.utils.reaper import exit_code, get_watcher
+from orbis.utils.scheduler import get_scheduler, Scheduler, Timeout
 
 
 class CommandHandler(HandlersInterface, Handler):
@@ -17,70 +32,522 @@ class CommandHandler(HandlersInterface, Handler):
         super(CommandHandler, self).__init__(**kw)
         self.log = True
 
-    def _exec(self, proc: subprocess.Popen, cmd_data: CommandData):
-        out = []
-        cmd = cmd_data.args.split()[0]
-        for line in proc.stdout:
-            decoded = line.decode()
-            out.append(decoded)
+    def get_kill_grace(self) -> float:
+        """
+            Returns the seconds a timed out command has to exit after SIGTERM before it is killed.
+        """
+        grace = self.app.get_config('kill_grace')
 
-            if self.app.pargs.verbose and self.log:
-                self.app.log.info(decoded, cmd)
+        return grace if grace else 0
 
-        cmd_data.output = ''.join(out)
+    def get_capture_config(self) -> dict:
+        capture = self.app.get_config('capture')
 
-        proc.wait(timeout=1)
+        return capture if capture else {}
 
-        if proc.returncode and proc.returncode != 0:
-            cmd_data.return_code = proc.returncode
-            proc.kill()
-            cmd_data.error = proc.stderr.read().decode()
+    def get_cgroup_config(self) -> dict:
+        cgroup = self.app.get_config('cgroup')
+
+        return cgroup if cgroup else {}
+
+    def _get_cgroup(self) -> Optional[CGroup]:
+        """
+            Returns a new cgroup for a command when cgroups are configured and the cgroup root can be used, otherwise
+            None, in which case the command runs without limits.
+        """
+        config = self.get_cgroup_config()
+
+        if not config:
+            return None
+
+        limits = CGroupLimits(memory_max=config.get('memory_max', None), cpu_max=config.get('cpu_max', None),
+                              pids_max=config.get('pids_max', None))
+        root = delegated_root(config.get('root', None), limits=limits, log=self.app.log.warning)
+
+        if root is None:
+            return None
+
+        try:
+            return CGroup.create(root, limits)
+        except OSError as e:
+            self.app.log.warning(f"Running command without cgroup limits: {e}")
+
+        return None
+
+    @staticmethod
+    def _get_spawn_args(cmd_data: CommandData, cgroup: CGroup = None) -> Tuple[Union[str, List[str]], bool]:
+        args, shell = cmd_data.get_spawn_args()
+
+        if cgroup:
+            return cgroup.wrap(['/bin/sh', '-c', args] if shell else args), False
+
+        return args, shell
+
+    @staticmethod
+    def _get_spawn_kwargs(cmd_data: CommandData) -> dict:
+        # no preexec_fn, which would disable the vfork/posix_spawn path of the spawns and is unsafe with threads
+        return dict(stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=materialize(cmd_data.env), cwd=cmd_data.cwd,
+                    start_new_session=True)
+
+    def _spawn(self, cmd_data: CommandData) -> Tuple[subprocess.Popen, Optional[CGroup]]:
+        cgroup = self._get_cgroup()
+        args, shell = self._get_spawn_args(cmd_data, cgroup)
+        kwargs = self._get_spawn_kwargs(cmd_data)
+
+        try:
+            try:
+                proc = subprocess.Popen(args=args, shell=shell, **kwargs)
+            except OSError as e:
+                if shell or e.errno != errno.ENOEXEC:
+                    raise
+
+                # like execvp, the scripts without a shebang are run by the shell
+                proc = subprocess.Popen(args=_sh_args(args, kwargs['env']), shell=False, **kwargs)
+        except BaseException:
+            if cgroup:
+                cgroup.close()
+            raise
+
+        self._started(cmd_data, proc.pid)
+
+        return proc, cgroup
+
+    async def _aspawn(self, cmd_data: CommandData) -> Tuple[asyncio.subprocess.Process, Optional[CGroup]]:
+        cgroup = self._get_cgroup()
+        args, shell = self._get_spawn_args(cmd_data, cgroup)
+        kwargs = self._get_spawn_kwargs(cmd_data)
+        # the asyncio subprocesses are reaped by the watcher, which keeps their rusage
+        get_watcher()
+
+        try:
+            try:
+                if shell:
+                    proc = await asyncio.create_subprocess_shell(args, **kwargs)
+                else:
+                    proc = await asyncio.create_subprocess_exec(*args, **kwargs)
+            except OSError as e:
+                if shell or e.errno != errno.ENOEXEC:
+                    raise
+
+                proc = await asyncio.create_subprocess_exec(*_sh_args(args, kwargs['env']), **kwargs)
+        except BaseException:
+            if cgroup:
+                cgroup.close()
+            raise
+
+        self._started(cmd_data, proc.pid)
+
+        return proc, cgroup
+
+    @staticmethod
+    def _started(cmd_data: CommandData, pid: int):
+        cmd_data.pid = cmd_data.pgid = pid
+        cmd_data.cmd_id = uuid.uuid4().hex
+        cmd_data.set_start()
+        channels = _get_channels(cmd_data)
+
+        if channels:
+            broker = get_broker()
+            broker.started(_command_channel(cmd_data))
+            broker.publish(channels, {'event': 'start', 'id': cmd_data.cmd_id, 'pid': cmd_data.pid,
+                                      'args': cmd_data.cmd_str})
+
+    @staticmethod
+    def _teardown(proc: subprocess.Popen, cmd_data: CommandData, cgroup: CGroup = None):
+        if proc.returncode is None:
+            # interrupted, the command runs in its own session and would not get the signal
+            signal_group(cmd_data.pgid, signal.SIGKILL)
+            _wait(proc)
+            _publish_end(cmd_data, proc.returncode, error="Command interrupted")
+
+        if cgroup:
+            cgroup.close()
+
+    @staticmethod
+    async def _ateardown(proc: asyncio.subprocess.Process, cmd_data: CommandData, cgroup: CGroup = None):
+        if proc.returncode is None:
+            signal_group(cmd_data.pgid, signal.SIGKILL)
+            await proc.wait()
+            _publish_end(cmd_data, proc.returncode, error="Command interrupted")
+
+        if cgroup:
+            # waits for the killed processes to be gone
+            await asyncio.get_running_loop().run_in_executor(None, cgroup.close)
+
+    def get_command_cache(self) -> Optional[CommandCache]:
+        """
+            Returns the cache of the memoized commands, kept under the cache directory (None if not configured).
+        """
+        cache_dir = self.app.get_config('cache_dir')
+
+        return CommandCache(Path(cache_dir).expanduser() / 'commands') if cache_dir else None
+
+    def _restore(self, cmd_data: CommandData, memo: Memo = None) -> Tuple[Optional[CommandCache], Optional[str]]:
+        """
+            Restores the results of a memoized command from the cache. Returns the cache and the key of the command for
+            storing its results, or no key if they were restored.
+        """
+        cache = self.get_command_cache() if memo else None
+
+        if cache is None:
+            return None, None
+
+        key = cache.key(cmd_data, memo, env=cmd_data.env)
+
+        if cache.restore(key, cmd_data, memo):
+            self.app.log.info(f"Restored the results of '{cmd_data.cmd_str}' from the command cache.")
+            return cache, None
+
+        return cache, key
+
+    @staticmethod
+    def _restored(cmd_data: CommandData) -> CommandData:
+        cmd_data.set_start()
+        cmd_data.set_end()
+        cmd_data.set_duration()
+
+        return cmd_data
+
+    def _memoize(self, cache: CommandCache, key: str, cmd_data: CommandData, memo: Memo):
+        # only successful commands are memoized
+        if cache and key and not cmd_data.error and not getattr(cmd_data, 'return_code', 0):
+            cache.save(key, cmd_data, memo)
+
+    def _get_buffers(self) -> Tuple[StreamBuffer, StreamBuffer]:
+        capture = self.get_capture_config()
+
+        return StreamBuffer(**capture), StreamBuffer(**capture)
+
+    def _get_line_logger(self, cmd_data: CommandData) -> Optional[Callable[[str], None]]:
+        if self.app.pargs.verbose and self.log:
+            cmd = cmd_data.program
+            return lambda line: self.app.log.info(line, cmd)
+
+        return None
+
+    def _get_line_callbacks(self, cmd_data: CommandData,
+                            on_line: Callable[[str], None] = None) -> Dict[str, Callable[[str], None]]:
+        """
+            Returns the callbacks for the lines of the stdout and stderr of the command: the logger, the supplied
+            callback, and the publishing of the lines when the command runs in a streaming context.
+        """
+        callbacks = {'stdout': [], 'stderr': []}
+        log_line = self._get_line_logger(cmd_data)
+
+        if log_line:
+            callbacks['stdout'].append(log_line)
+
+        if on_line:
+            callbacks['stdout'].append(on_line)
+
+        channels = _get_channels(cmd_data)
+
+        if channels:
+            broker = get_broker()
+
+            for name, stream_callbacks in callbacks.items():
+                stream_callbacks.append(lambda line, name=name: broker.publish(channels, {
+                    'event': 'line', 'id': cmd_data.cmd_id, 'pid': cmd_data.pid, 'stream': name, 'line': line}))
+
+        return {name: _chain(stream_callbacks) for name, stream_callbacks in callbacks.items() if stream_callbacks}
+
+    def _schedule_timeout(self, proc: subprocess.Popen, cmd_data: CommandData) -> Optional['CommandTimer']:
+        if cmd_data.timeout:
+            return CommandTimer(proc, cmd_data, grace=self.get_kill_grace(), scheduler=get_scheduler(self.app.log))
+
+        return None
+
+    def _set_result(self, cmd_data: CommandData, return_code: int, out: StreamBuffer, err: StreamBuffer):
+        cmd_data.output = out.text()
+        cmd_data.output_file = out.file if out.keep_file else None
+
+        if return_code and return_code != 0:
+            cmd_data.return_code = return_code
+
+            # keeps the timeout as the error of the command
+            if cmd_data.timed_out_at is None:
+                cmd_data.error = err.text()
+                cmd_data.error_file = err.file if err.keep_file else None
+
+            if cmd_data.usage and cmd_data.usage.oom_kills:
+                cmd_data.error = f"Command killed for exceeding the cgroup memory limit\n{cmd_data.error or ''}"
 
             if cmd_data.error:
                 self.app.log.error(cmd_data.error)
 
-    def __call__(self, cmd_data: CommandData, msg: str = None, raise_err: bool = False, exit_err: bool = False,
-                 **kwargs) -> CommandData:
+    @staticmethod
+    def _release(cmd_data: CommandData, *buffers: StreamBuffer):
+        """
+            Removes the spilled files of the buffers, but those kept as the full output or error of the command. The
+            error of a command that timed out is never kept.
+        """
+        for buffer in buffers:
+            if not (buffer.spilled and buffer.file in (cmd_data.output_file, cmd_data.error_file)):
+                buffer.discard()
+
+    def _exec(self, proc: subprocess.Popen, cmd_data: CommandData, cgroup: CGroup = None):
+        out, err = self._get_buffers()
+        callbacks = self._get_line_callbacks(cmd_data)
+        pipes = {'stdout': proc.stdout, 'stderr': proc.stderr}
 
+        try:
+            # both pipes are drained at the same time, a process filling the stderr pipe would otherwise hang
+            drain({proc.stdout: out, proc.stderr: err}, on_line={pipes[name]: cb for name, cb in callbacks.items()})
+            cmd_data.usage = _wait(proc)
+
+            if cgroup and cmd_data.usage:
+                cgroup.update(cmd_data.usage)
+
+            self._set_result(cmd_data, proc.returncode, out, err)
+        finally:
+            self._release(cmd_data, out, err)
+
+    def _begin(self, cmd_data: CommandData, msg: str = None):
         if msg and self.app.pargs.verbose:
             self.app.log.info(msg)
 
-        self.app.log.debug(cmd_data.args, cmd_data.cwd)
+        self.app.log.debug(cmd_data.cmd_str, cmd_data.cwd)
+
+    def _end(self, cmd_data: CommandData, return_code: int, raise_err: bool = False, exit_err: bool = False):
+        cmd_data.set_end()
+        cmd_data.set_duration()
+        _publish_end(cmd_data, return_code)
+
+        if raise_err and cmd_data.error:
+            raise CommandError(cmd_data.error)
+
+        if exit_err and cmd_data.error:
+            exit(return_code)
+
+    def _spawn_failed(self, cmd_data: CommandData, e: OSError, raise_err: bool = False,
+                      exit_err: bool = False) -> CommandData:
+        """
+            Reports a program that could not be spawned the way the shell would: 127 when it is not found, 126 when it
+            can not be executed (or for any other error of the spawn).
+        """
+        cmd_data.set_start()
+        cmd_data.return_code = 127 if isinstance(e, FileNotFoundError) else 126
+        cmd_data.error = f"{cmd_data.program}: {e.strerror if e.strerror else e}"
+        self.app.log.error(cmd_data.error)
+        self._end(cmd_data, cmd_data.return_code, raise_err=raise_err, exit_err=exit_err)
 
-        with subprocess.Popen(args=cmd_data.args, shell=True, stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE, env=cmd_data.env, cwd=cmd_data.cwd) as proc:
-            cmd_data.pid = proc.pid
-            cmd_data.set_start()
+        return cmd_data
 
-            if cmd_data.timeout:
-                timer = Timer(cmd_data.timeout+1, _timer_out, args=[proc, cmd_data])
-                timer.start()
-                self._exec(proc, cmd_data)
-                proc.stdout.close()
-                timer.cancel()
-            else:
-                self._exec(proc, cmd_data)
+    def __call__(self, cmd_data: CommandData, msg: str = None, raise_err: bool = False, exit_err: bool = False,
+                 memo: Memo = None, **kwargs) -> CommandData:
+        """
+            Runs the command.
+
+            :param memo: declares the inputs and outputs of a deterministic command to memoize it in the command cache
+        """
+        self._begin(cmd_data, msg)
+        cache, key = self._restore(cmd_data, memo)
+
+        if cache and key is None:
+            return self._restored(cmd_data)
+
+        try:
+            proc, cgroup = self._spawn(cmd_data)
+        except OSError as e:
+            return self._spawn_failed(cmd_data, e, raise_err=raise_err, exit_err=exit_err)
 
-            cmd_data.set_end()
-            cmd_data.set_duration()
+        with proc:
+            timeout = self._schedule_timeout(proc, cmd_data)
 
-            if raise_err and cmd_data.error:
-                raise CommandError(cmd_data.error)
+            try:
+                self._exec(proc, cmd_data, cgroup)
+            finally:
+                if timeout:
+                    timeout.cancel()
 
-            if exit_err and cmd_data.error:
-                exit(proc.returncode)
+                self._teardown(proc, cmd_data, cgroup)
+
+            self._memoize(cache, key, cmd_data, memo)
+            self._end(cmd_data, proc.returncode, raise_err=raise_err, exit_err=exit_err)
 
             return cmd_data
 
+    async def acall(self, cmd_data: CommandData, msg: str = None, raise_err: bool = False, exit_err: bool = False,
+                    on_line: Callable[[str], None] = None, memo: Memo = None, **kwargs) -> CommandData:
+        """
+            Async counterpart of __call__: runs the command in the event loop, so that a single process can drive many
+            commands at the same time. Timeouts go through the same scheduler as the blocking calls.
+
+            :param on_line: callback for the lines of the output, as they are written
+            :param memo: declares the inputs and outputs of a deterministic command to memoize it in the command cache
+        """
+        self._begin(cmd_data, msg)
+        cache, key = self._restore(cmd_data, memo)
+
+        if cache and key is None:
+            return self._restored(cmd_data)
+
+        try:
+            proc, cgroup = await self._aspawn(cmd_data)
+        except OSError as e:
+            return self._spawn_failed(cmd_data, e, raise_err=raise_err, exit_err=exit_err)
+
+        timeout = self._schedule_timeout(proc, cmd_data)
+        out, err = self._get_buffers()
+        callbacks = self._get_line_callbacks(cmd_data, on_line=on_line)
+
+        try:
+            readers = {'stdout': proc.stdout, 'stderr': proc.stderr}
+            await adrain({proc.stdout: out, proc.stderr: err},
+                         on_line={readers[name]: cb for name, cb in callbacks.items()})
+            await proc.wait()
+            watcher = get_watcher()
+            cmd_data.usage = watcher.pop_usage(proc.pid) if watcher else None
+
+            if cgroup and cmd_data.usage:
+                cgroup.update(cmd_data.usage)
+
+            self._set_result(cmd_data, proc.returncode, out, err)
+        finally:
+            if timeout:
+                timeout.cancel()
+
+            self._release(cmd_data, out, err)
+            await self._ateardown(proc, cmd_data, cgroup)
+
+        self._memoize(cache, key, cmd_data, memo)
+        self._end(cmd_data, proc.returncode, raise_err=raise_err, exit_err=exit_err)
+
+        return cmd_data
+
+
+def _get_channels(cmd_data: CommandData) -> Tuple[str, ...]:
+    """
+        Returns the channels the events of the command are published to, none when not in a streaming context.
+    """
+    channels = stream_channels.get()
+
+    return channels + (_command_channel(cmd_data),) if channels else ()
+
+
+def _command_channel(cmd_data: CommandData) -> str:
+    return f"command:{cmd_data.cmd_id}"
+
+
+def _publish_end(cmd_data: CommandData, return_code: int, error: str = None):
+    """
+        Publishes the end of a started command, after which its channel is no longer live.
+    """
+    channels = _get_channels(cmd_data)
+
+    if channels and cmd_data.cmd_id:
+        broker = get_broker()
+        broker.publish(channels, {'event': 'end', 'id': cmd_data.cmd_id, 'pid': cmd_data.pid,
+                                  'return_code': return_code, 'error': cmd_data.error or error,
+                                  'duration': cmd_data.duration})
+        broker.ended(_command_channel(cmd_data))
+
+
+def _which(program: str, env: Optional[Dict[str, str]]) -> str:
+    """
+        Returns the path of the program the way execvp finds it, in the PATH of the command unless it has a slash.
+    """
+    if '/' in program:
+        return program
+
+    path = (env if env is not None else os.environ).get('PATH', None)
+
+    return shutil.which(program, path=path) or program
+
+
+def _chain(callbacks: List[Callable[[str], None]]) -> Callable[[str], None]:
+    if len(callbacks) == 1:
+        return callbacks[0]
+
+    def call(line: str):
+        for callback in callbacks:
+            callback(line)
+
+    return call
+
+
+def _sh_args(args: List[str], env: Optional[Dict[str, str]]) -> List[str]:
+    return ['/bin/sh', _which(args[0], env), *args[1:]]
+
+
+def _wait(proc: subprocess.Popen) -> Optional[Usage]:
+    """
+        Waits for the process with wait4 to collect its resource usage, and sets its return code.
+    """
+    if proc.returncode is None:
+        try:
+            _, status, rusage = os.wait4(proc.pid, 0)
+        except ChildProcessError:
+            # already reaped elsewhere
+            proc.wait()
+            return None
+
+        proc.returncode = exit_code(status)
+
+        return Usage.from_rusage(rusage)
+
+    return None
+
+
+def signal_group(pgid: int, sig: int) -> bool:
+    """
+        Sends the signal to the process group of a command. Returns False if the group has no processes left.
+    """
+    if not pgid:
+        return False
+
+    try:
+        os.killpg(pgid, sig)
+    except (ProcessLookupError, PermissionError):
+        return False
+
+    return True
+
+
+class CommandTimer:
+    """
+        Timeout of a running command. Once the command is reaped, cancelling the timer also cancels the pending SIGKILL
+        of the grace period, which could otherwise reach a new process group that reused the id.
+    """
+
+    def __init__(self, proc: subprocess.Popen, cmd_data: CommandData, grace: float = 0, scheduler: Scheduler = None):
+        self.scheduler = scheduler if scheduler else get_scheduler()
+        self.kill: Optional[Timeout] = None
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self.timeout = self.scheduler.schedule(cmd_data.timeout + 1, lambda: self._time_out(proc, cmd_data, grace))
+
+    def _time_out(self, proc: subprocess.Popen, cmd_data: CommandData, grace: float):
+        with self._lock:
+            if not self._cancelled:
+                self.kill = _timer_out(proc, cmd_data, grace=grace, scheduler=self.scheduler)
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            self.timeout.cancel()
+
+            if self.kill:
+                self.kill.cancel()
+
 
 # https://stackoverflow.com/a/54775443
-def _timer_out(p: subprocess.Popen, cmd_data: CommandData):
+def _timer_out(p: subprocess.Popen, cmd_data: CommandData, grace: float = 0,
+               scheduler: Scheduler = None) -> Optional[Timeout]:
+    """
+        Stops the timed out command: sends SIGTERM to its process group and SIGKILL to the processes still in the group
+        after the grace period (or SIGKILL right away if there is no grace period). Returns the scheduled SIGKILL.
+    """
+    cmd_data.timed_out_at = datetime.now()
     cmd_data.error = "Command timed out"
 #    cmd_data.timeout = True
-    process = psutil.Process(p.pid)
     cmd_data.return_code = p.returncode if p.returncode else 3
 
-    for proc in process.children(recursive=True):
-        proc.kill()
+    if grace:
+        if signal_group(cmd_data.pgid, signal.SIGTERM):
+            scheduler = scheduler if scheduler else get_scheduler()
+            return scheduler.schedule(grace, lambda: signal_group(cmd_data.pgid, signal.SIGKILL))
+    else:
+        signal_group(cmd_data.pgid, signal.SIGKILL)
 
-    process.kill()
+    return None
@@ -1,3 +1,5 @@
+import asyncio
+import os
 from pathlib import Path
 from typing import List, Dict, Tuple
 
@@ -45,6 +47,16 @@ class BuildHandler(MakeHandler):
         self.app.log.info(f"Built {target}.")
         return cmd_data
 
+    async def acmake_build(self, target: str, env: dict = None, cwd: str = None, **kwargs) -> CommandData:
+        """
+            Async counterpart of cmake_build.
+        """
+        args = args_to_str(kwargs) if kwargs else ""
+        cmd_data = CommandData(args=f"cmake --build . --target {target} {args}", cwd=cwd, env=env)
+        await self.acall(cmd_data=cmd_data, msg=f"Building {target}\n", raise_err=True)
+        self.app.log.info(f"Built {target}.")
+        return cmd_data
+
     def cmake_build_preprocessed(self, inst_commands: Dict[str, str], build_path: Path) -> CommandData:
         """
             Builds the instrumented preprocessed files to objects.
@@ -54,7 +66,7 @@ class BuildHandler(MakeHandler):
         """
 
         if not inst_commands:
-            raise OrbisError(f"No instrumented commands.")
+            raise OrbisError("No instrumented commands.")
 
         cmd_data = CommandData.get_blank()
 
@@ -65,6 +77,35 @@ class BuildHandler(MakeHandler):
 
         return cmd_data
 
+    async def acmake_build_preprocessed(self, inst_commands: Dict[str, str], build_path: Path) -> List[CommandData]:
+        """
+            Async counterpart of cmake_build_preprocessed, builds the instrumented preprocessed files at the same time,
+            up to the configured build jobs.
+            :param inst_commands: Dictionary with the modified cmake commands for building the instrumented files.
+            :param build_path: Path to the build directory.
+            :return: Command outcomes for the built files.
+        """
+
+        if not inst_commands:
+            raise OrbisError("No instrumented commands.")
+
+        self.app.log.info(f"Building preprocessed files {list(inst_commands.keys())}.")
+        jobs = asyncio.Semaphore(self.get_build_jobs())
+
+        async def build(file: str, command: str) -> CommandData:
+            async with jobs:
+                return await self.abuild_preprocessed_file(file, command, build_path=build_path)
+
+        return await asyncio.gather(*[build(file, command) for file, command in inst_commands.items()])
+
+    def get_build_jobs(self) -> int:
+        """
+            Returns the number of files built at the same time by the async builds, defaults to the number of CPUs.
+        """
+        jobs = self.app.get_config('build_jobs')
+
+        return jobs if jobs else os.cpu_count() or 1
+
     def build_preprocessed_file(self, file: str, command: str, build_path: Path) -> CommandData:
         if Path(file).exists():
             return super().__call__(CommandData(args=command, cwd=str(build_path)), raise_err=True,
@@ -72,6 +113,13 @@ class BuildHandler(MakeHandler):
 
         raise OrbisError(f"File {file} not found.")
 
+    async def abuild_preprocessed_file(self, file: str, command: str, build_path: Path) -> CommandData:
+        if Path(file).exists():
+            return await self.acall(CommandData(args=command, cwd=str(build_path)), raise_err=True,
+                                    msg=f"Creating object file for {file}.\n")
+
+        raise OrbisError(f"File {file} not found.")
+
     def cmake_link_executable(self, source_path: Path, cmake_path: Path, build_path: Path,
                               env: dict = None) -> CommandData:
         self.app.log.info(f"Linking into executable {source_path.name}.")
@@ -7,6 +7,14 @@ from orbis.ext.database import CompileOutcome, Instance
 
 from orbis.data.misc import Context
 from orbis.data.results import CommandData
+from orbis.data.snapshot import content_hash
+
+
+def build_flags(args: dict = None) -> str:
+    """
+        Returns the digest of the args of a build, the same for the same args in any order.
+    """
+    return content_hash(json.dumps(args if args else {}, sort_keys=True, default=str))
 
 
 class MakeHandler(CommandHandler):
@@ -55,9 +63,10 @@ class MakeHandler(CommandHandler):
 
             dest.chmod(0o777)
 
-    def save_outcome(self, cmd_data: CommandData, context: Context, tag: str = None):
+    def save_outcome(self, cmd_data: CommandData, context: Context, tag: str = None, args: dict = None):
         outcome = CompileOutcome(instance_id=context.instance.id, error=cmd_data.error, exit_status=cmd_data.exit_status,
-                                 tag=tag if tag else self.Meta.label)
+                                 tag=tag if tag else self.Meta.label, flags=build_flags(args))
+        outcome.set_usage(cmd_data.usage)
 
         co_id = self.app.db.add(outcome)
         self.app.db.update(entity=Instance, entity_id=context.instance.id, attr='pointer', value=co_id)
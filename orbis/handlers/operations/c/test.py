@@ -1,17 +1,28 @@
+import contextvars
+import math
 import os
-import signal
-import sys
 import psutil
+import queue
+import signal
+import tempfile
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import replace
 from pathlib import Path
-from typing import List, Tuple, Callable
+from typing import Tuple, Callable, List, Union, Iterator
 
 from orbis.data.misc import Context
-from orbis.ext.database import TestOutcome
+from orbis.data.history import TestHistory
+from orbis.ext.database import CompileOutcome, TestOutcome, OutcomeWriter
 
-from orbis.data.results import CommandData
-from orbis.handlers.command import CommandHandler
-from orbis.data.schema import Test
+from orbis.data.results import CommandData, Usage
+from orbis.data.snapshot import content_hash
+from orbis.handlers.command import CommandHandler, signal_group
+from orbis.data.env import EnvOverlay, materialize
+from orbis.data.schema import Test, Oracle
+from orbis.utils.fingerprint import source_fingerprint
 
 
 class TestHandler(CommandHandler):
@@ -21,9 +32,30 @@ class TestHandler(CommandHandler):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.failed = False
+        self.writer: OutcomeWriter = None
+
+    @contextmanager
+    def buffered(self) -> Iterator[OutcomeWriter]:
+        """
+            Buffers the outcomes of the tests run within the block, to insert them in batches. The outcomes left in the
+            buffer are inserted when the block ends.
+        """
+        if self.writer is not None:
+            yield self.writer
+            return
+
+        config = self.app.get_config('outcome_writer')
+        self.writer = OutcomeWriter(self.app.db, log=self.app.log.error, **(config if config else {}))
+
+        try:
+            with self.writer:
+                yield self.writer
+        finally:
+            self.writer = None
 
     def run(self, context: Context, test: Test, timeout: int, cwd: str = None, script: str = None, env: dict = None,
-            args: str = None, process_outcome: Callable = None, kill: bool = False) -> Tuple[CommandData, TestOutcome]:
+            args: str = None, process_outcome: Callable = None, kill: bool = False, fingerprint: str = None,
+            save: bool = True) -> Tuple[CommandData, TestOutcome]:
         """
             Runs the test and saves the outcome into the database.
 
@@ -35,64 +67,360 @@ class TestHandler(CommandHandler):
             :param args: args to associate to the test (overwrites the args associated to the test)
             :param env: dictionary with the environment variables
             :param kill: kills the associated processes to the executed command
-            :param process_outcome: Function that receives 3 arguments (cmd_data, test, and the test_outcome)
+            :param process_outcome: Function that receives 3 arguments (cmd_data, test, and the test_outcome) and
+                                    returns the pids to kill, along with the process group of the command
+            :param fingerprint: fingerprint of the instance (see get_fingerprint), reuses the outcome of the same test
+                            and command for the fingerprint and the flags of the build instead of running the test
+            :param save: saves the outcome, otherwise it is left to the caller
         """
 
-        if script and (not test.script or test.script == ""):
-            test.script = script
+        test, cmd_data = self._get_command(test, timeout, cwd=cwd, script=script, env=env, args=args)
+        key = self._get_key(fingerprint, context, test, cmd_data)
 
-        if args and not test.args:
-            test.args = args
+        if key:
+            cached = self._get_cached(context, test, key, save=save)
+
+            if cached:
+                return cached
 
-        cmd_data = CommandData(args=f"{test.script} {test.args}", cwd=cwd, env=env,
-                               timeout=test.timeout if test.timeout else timeout)
         cmd_data = super().__call__(cmd_data=cmd_data, raise_err=False, exit_err=False,
                                     msg=f"Testing {test.id} on {test.file}\n")
-        pids = [str(cmd_data.pid)]
+
+        return cmd_data, self._get_outcome(context, test, timeout, cmd_data, process_outcome=process_outcome, kill=kill,
+                                           fingerprint=key, save=save)
+
+    async def arun(self, context: Context, test: Test, timeout: int, cwd: str = None, script: str = None,
+                   env: dict = None, args: str = None, process_outcome: Callable = None, kill: bool = False,
+                   fingerprint: str = None) -> Tuple[CommandData, TestOutcome]:
+        """
+            Async counterpart of run, to drive several tests at the same time from an event loop.
+        """
+        test, cmd_data = self._get_command(test, timeout, cwd=cwd, script=script, env=env, args=args)
+        key = self._get_key(fingerprint, context, test, cmd_data)
+
+        if key:
+            cached = self._get_cached(context, test, key)
+
+            if cached:
+                return cached
+
+        cmd_data = await self.acall(cmd_data=cmd_data, raise_err=False, exit_err=False,
+                                    msg=f"Testing {test.id} on {test.file}\n")
+
+        return cmd_data, self._get_outcome(context, test, timeout, cmd_data, process_outcome=process_outcome, kill=kill,
+                                           fingerprint=key)
+
+    def get_fingerprint(self, context: Context, env: dict = None) -> str:
+        """
+            Returns the fingerprint of the instance: the content of its source tree (the build directory aside), the
+            build configurations of the project and the environment of the tests. Outcomes are only reused for the same
+            fingerprint, so any change to the sources or flags runs the tests again.
+        """
+        variables = materialize(env)
+        parts = [source_fingerprint(context.source, exclude=[context.build]), str(context.project.build.jsonify())]
+
+        if variables is not None:
+            parts.extend(f"{k}={v}" for k, v in sorted(variables.items()))
+
+        fingerprint = content_hash(*parts)
+        self.app.log.debug(f"Fingerprint of instance {context.instance.id}: {fingerprint}")
+
+        return fingerprint
+
+    def get_workers(self) -> int:
+        """
+            Returns the number of tests run at the same time by run_batch, defaults to the number of CPUs.
+        """
+        workers = self.app.get_config('test_workers')
+
+        return workers if workers else os.cpu_count() or 1
+
+    def get_flaky_config(self) -> dict:
+        flaky = self.app.get_config('flaky')
+
+        return flaky if flaky else {}
+
+    def get_adaptive_timeout_config(self) -> dict:
+        adaptive_timeout = self.app.get_config('adaptive_timeout')
+
+        return adaptive_timeout if adaptive_timeout else {}
+
+    def run_batch(self, context: Context, tests: Oracle, timeout: int, workers: int = None,
+                  cwd: Union[str, Callable[[int], str]] = None, script: str = None, env: dict = None, args: str = None,
+                  process_outcome: Callable = None, kill: bool = False, prioritize: bool = False,
+                  fail_fast: bool = False, cache: bool = False, reruns: int = None,
+                  adaptive_timeout: bool = False) -> List[Tuple[CommandData, TestOutcome]]:
+        """
+            Runs the test cases of the oracle across a pool of workers and saves the outcomes into the database.
+            Each worker runs its tests with its own env overlay, with the worker id (ORBIS_WORKER) and a scratch
+            directory (TMPDIR), so that concurrent tests do not share temporary files.
+
+            :param context: the instance with the associated directory and the program
+            :param tests: the oracle with the test cases to be run
+            :param timeout: timeout to stop the execution of the tests without their own timeout
+            :param workers: number of tests run at the same time (defaults to the configured test workers), at most the
+                            connections of the database pool
+            :param cwd: working directory for running the tests, or function returning it for the worker id
+            :param script: script file or command to invoke the tests (defaults to the script of the oracle)
+            :param env: dictionary with the environment variables
+            :param args: args to associate to the tests (defaults to the args of the oracle)
+            :param process_outcome: Function that receives 3 arguments (cmd_data, test, and the test_outcome) and
+                                    returns the pids to kill, along with the process group of the command
+            :param kill: kills the associated processes to the executed command
+            :param prioritize: runs first the test cases most likely to fail per second, based on the outcomes of the
+                            past runs of the tests for the project
+            :param fail_fast: stops at the first failing test case, the test cases not run are reported as skipped
+                            (not passed, see TestOutcome.skipped) and not saved
+            :param cache: reuses the outcomes of the tests for the same fingerprint of the instance and flags of the
+                            build, rather than running them again (see get_fingerprint)
+            :param reruns: times a flaky test case is rerun when its outcome disagrees with its past outcomes (defaults
+                            to the configured flaky reruns), within the configured budget of reruns of the batch. The
+                            reported outcome is the majority of the runs, all the runs are saved
+            :param adaptive_timeout: sets the timeout of each test case from a percentile of the durations of its past
+                            runs, times a safety factor (see the adaptive timeout configs), bounded by its timeout
+            :return: the command and the outcome of each test case, in the order of the oracle
+        """
+        cases = sorted(tests.cases.values(), key=lambda t: t.order)
+        workers = max(1, min(workers if workers else self.get_workers(), len(cases)))
+        pool_limit = self.app.db.get_pool_limit()
+
+        # each worker may hold a connection of the pool, more workers would wait for the pool to time out
+        if pool_limit and workers > pool_limit:
+            self.app.log.warning(f"Running the tests with {pool_limit} workers, the size of the database pool.")
+            workers = pool_limit
+
+        script = script if script else tests.script
+        args = args if args else tests.args
+        flaky = self.get_flaky_config()
+        reruns = reruns if reruns is not None else flaky.get('reruns', 0)
+        percentile = self.get_adaptive_timeout_config().get('percentile', 95) if adaptive_timeout else None
+        history = self.app.db.test_history(context.project.id, percentile=percentile) \
+            if prioritize or reruns or adaptive_timeout else None
+
+        if adaptive_timeout:
+            cases = [self._adapt_timeout(history, test, timeout) for test in cases]
+
+        schedule = history.prioritize(cases) if prioritize else cases
+        stop = threading.Event()
+        fingerprint = self.get_fingerprint(context, env) if cache else None
+        budget = threading.Semaphore(flaky['budget']) if flaky.get('budget', None) is not None else None
+
+        with tempfile.TemporaryDirectory(prefix='orbis-workers-') as scratch:
+            slots = queue.Queue()
+
+            for worker in range(workers):
+                worker_dir = Path(scratch, str(worker))
+                worker_dir.mkdir()
+                slots.put((worker, EnvOverlay(env, {'ORBIS_WORKER': worker, 'TMPDIR': worker_dir})))
+
+            def run(test: Test) -> Tuple[CommandData, TestOutcome]:
+                # the cases are picked in the order of the schedule, the ones after the failure are skipped
+                if stop.is_set():
+                    return CommandData.get_blank(), self._get_skipped(context, test)
+
+                worker, worker_env = slots.get()
+
+                def attempt(key: str = None) -> Tuple[CommandData, TestOutcome]:
+                    return self.run(context, test, timeout, cwd=cwd(worker) if callable(cwd) else cwd, script=script,
+                                    env=worker_env, args=args, process_outcome=process_outcome, kill=kill,
+                                    fingerprint=key, save=False)
+
+                try:
+                    attempts = [attempt(fingerprint)]
+
+                    # only the flaky tests disagreeing with their history are rerun, until the majority agrees
+                    if history and reruns and not attempts[0][0].memoized \
+                            and history.is_flaky(test, flaky.get('threshold', 0)):
+                        expected = history.expects_pass(test)
+
+                        while len(attempts) <= reruns and _majority(attempts) is not expected \
+                                and (budget is None or budget.acquire(blocking=False)):
+                            self.app.log.info(f"Rerunning flaky test {test.id} ({len(attempts)} of {reruns}).")
+                            attempts.append(attempt())
+                finally:
+                    slots.put((worker, worker_env))
+
+                key = attempts[0][1].fingerprint
+                cmd_data, outcome = self._settle(attempts, history.flakiness(test) if history else None)
+
+                # only the settled outcome is reused for the fingerprint
+                for _, attempt_outcome in attempts:
+                    attempt_outcome.fingerprint = key if attempt_outcome is outcome else None
+                    self._save(context, attempt_outcome)
+
+                if fail_fast and not outcome.passed:
+                    stop.set()
+
+                return cmd_data, outcome
+
+            self.app.log.info(f"Running {len(cases)} tests with {workers} workers.")
+
+            with self.buffered(), ThreadPoolExecutor(max_workers=workers, thread_name_prefix='orbis-test') as executor:
+                # the tests run in the context of the caller (e.g., the channels the output is streamed to)
+                futures = [(test, executor.submit(contextvars.copy_context().run, run, test)) for test in schedule]
+                results = {test.id: future.result() for test, future in futures}
+
+        if stop.is_set():
+            skipped = sum(1 for _, outcome in results.values() if outcome.skipped)
+            self.app.log.info(f"Stopped at the first failure, skipped {skipped} tests.")
+
+        return [results[test.id] for test in cases]
+
+    def _adapt_timeout(self, history: TestHistory, test: Test, timeout: int) -> Test:
+        """
+            Returns the test case with the timeout learned from its history, in whole seconds (rounded up), never above
+            its timeout (or the given one), nor below the configured minimum. The test case is kept when there is not
+            enough history.
+        """
+        config = self.get_adaptive_timeout_config()
+        learned = history.timeout(test, factor=config.get('factor', 2), min_runs=config.get('min_runs', 5))
+
+        if learned is None:
+            return test
+
+        bound = test.timeout if test.timeout else timeout
+        learned = math.ceil(min(max(learned, config.get('minimum', 1)), bound))
+        self.app.log.debug(f"Learned timeout of {test.id}: {learned}s (bound {bound}s).")
+
+        # the test is replaced rather than updated, as it is shared with the catalog
+        return replace(test, timeout=learned)
+
+    @staticmethod
+    def _settle(attempts: List[Tuple[CommandData, TestOutcome]],
+                flakiness: float = None) -> Tuple[CommandData, TestOutcome]:
+        """
+            Returns the latest run with the result of the majority of the runs (or of the latest run, on ties), and sets
+            its confidence: the share of runs agreeing with it, or the chance of a single run of not being flaky.
+        """
+        result = _majority(attempts)
+        result = attempts[-1][1].passed if result is None else result
+        cmd_data, outcome = [a for a in attempts if a[1].passed is result][-1]
+
+        if len(attempts) > 1:
+            outcome.confidence = round(sum(1 for _, o in attempts if o.passed is result) / len(attempts), 3)
+        elif flakiness is not None:
+            outcome.confidence = round(1 - flakiness, 3)
+
+        return cmd_data, outcome
+
+    @staticmethod
+    def _get_skipped(context: Context, test: Test) -> TestOutcome:
+        return TestOutcome(instance_id=context.instance.id, co_id=context.instance.pointer, name=test.id,
+                           order=test.order, is_pov=test.is_pov, duration=0, exit_status=0, passed=False,
+                           msg="Test skipped")
+
+    @staticmethod
+    def _get_command(test: Test, timeout: int, cwd: str = None, script: str = None, env: dict = None,
+                     args: str = None) -> Tuple[Test, CommandData]:
+        # the test is replaced rather than updated, as it is shared with the catalog
+        if script and (not test.script or test.script == ""):
+            test = replace(test, script=script)
+
+        if args and not test.args:
+            test = replace(test, args=args)
+
+        return test, CommandData(args=f"{test.script} {test.args}", cwd=cwd, env=env,
+                                 timeout=test.timeout if test.timeout else timeout)
+
+    def _get_key(self, fingerprint: str, context: Context, test: Test, cmd_data: CommandData) -> Union[str, None]:
+        """
+            Returns the key of the outcome of the test for the fingerprint and the flags of the last build of the
+            instance (the build args are not part of the fingerprint), so that the rebuilds with the same flags reuse
+            it. None when the flags of the build are unknown. The timeout is left out, as it changes with the adaptive
+            timeouts; the outcomes that timed out are not reused instead.
+        """
+        if not fingerprint or context.instance.pointer is None:
+            return None
+
+        build = self.app.db.query(CompileOutcome, entity_id=context.instance.pointer)
+
+        if build is None or build.flags is None:
+            return None
+
+        return content_hash(fingerprint, build.flags, test.id, cmd_data.cmd_str)
+
+    def _get_cached(self, context: Context, test: Test, key: str,
+                    save: bool = True) -> Union[Tuple[CommandData, TestOutcome], None]:
+        cached = self.app.db.find_outcome(key)
+
+        if cached is None or cached.error == "Test timed out":
+            return None
+
+        outcome = TestOutcome(instance_id=context.instance.id, co_id=context.instance.pointer, name=test.id,
+                              order=test.order, is_pov=cached.is_pov, passed=cached.passed, msg=cached.msg,
+                              error=cached.error, exit_status=cached.exit_status, sig=cached.sig,
+                              duration=cached.duration, fingerprint=key, cached=True)
+        cmd_data = CommandData.get_blank()
+        cmd_data.exit_status, cmd_data.error, cmd_data.memoized = cached.exit_status, cached.error, True
+        cmd_data.usage = Usage(**cached.usage_dict())
+        outcome.set_usage(cmd_data.usage)
+        self.app.log.info(f"Reusing the outcome {cached.id} of {test.id} for the same fingerprint.")
+
+        if save:
+            self._save(context, outcome)
+
+        return cmd_data, outcome
+
+    def _get_outcome(self, context: Context, test: Test, timeout: int, cmd_data: CommandData,
+                     process_outcome: Callable = None, kill: bool = False, fingerprint: str = None,
+                     save: bool = True) -> TestOutcome:
         outcome = TestOutcome(instance_id=context.instance.id, co_id=context.instance.pointer, name=test.id,
                               duration=round(cmd_data.duration, 3), exit_status=cmd_data.exit_status, order=test.order,
-                              error=cmd_data.error, passed=True if not cmd_data.error else False)
+                              is_pov=test.is_pov, error=cmd_data.error, passed=True if not cmd_data.error else False,
+                              fingerprint=fingerprint)
+        outcome.set_usage(cmd_data.usage)
 
 #        if outcome.duration > timeout and outcome.error and outcome.exit_status != 0:
-        if outcome.duration > timeout:
+        if outcome.duration > (cmd_data.timeout if cmd_data.timeout else timeout):
             outcome.error = "Test timed out"
 
+        pids = [cmd_data.pid]
+
         if process_outcome:
             pids = process_outcome(cmd_data, test, outcome)
 
         if kill:
             if cmd_data.error and outcome.sig not in [signal.SIGSEGV, signal.SIGILL, signal.SIGBUS]:
                 # Try to kill erroneous process with no crash
-                self.kill_process(name=context.project.name, target_pids=pids)
+                self.kill_process(name=context.project.name, target_pids=pids, pgid=cmd_data.pgid)
 
-        t_id = self.app.db.add(outcome)
-        self.app.log.debug(f"Inserted 'test outcome' with id {t_id} for instance {context.instance.id}.")
+        if save:
+            self._save(context, outcome)
 
-        return cmd_data, outcome
+        return outcome
+
+    def _save(self, context: Context, outcome: TestOutcome):
+        if self.writer is not None:
+            self.writer.add(outcome)
+        else:
+            t_id = self.app.db.add(outcome)
+            self.app.log.debug(f"Inserted 'test outcome' with id {t_id} for instance {context.instance.id}.")
 
-    def kill_process(self, name: str, target_pids: List[str] = None):
+    def kill_process(self, name: str, target_pids: List[Union[int, str]] = None, pgid: int = None) -> List[int]:
         """
-        Gets a list of all the PIDs of the running process whose name contains the given string process_name and
-        kills the process. If target_pids list is supplied, it checks the pids for the process with the list
+            Kills the processes left behind by a command: the processes still in its process group, and the target
+            pids (e.g., the processes that left the group) whose name contains the given name. The process table is
+            not scanned, only the target pids are checked.
+
+            :param name: the name of the processes
+            :param target_pids: the pids of the processes to kill
+            :param pgid: the process group of the command
         """
-        # based on https://thispointer.com/python-check-if-a-process-is-running-by-name-and-find-its-process-id-pid/
-        # Iterate over the all the running process
         self.app.log.warning(f"Killing {name} process.")
-
         killed_pids = []
 
-        for proc in psutil.process_iter():
+        if signal_group(pgid, signal.SIGKILL):
+            self.app.log.info(f"Killed process group {pgid}.")
+
+        for pid in target_pids or []:
             try:
-                proc_info = proc.as_dict(attrs=['pid', 'name', 'create_time'])
-                # Check if process name contains the given name string.
-                if name in proc_info['name']:
-                    if psutil.pid_exists(proc_info['pid']):
-                        if target_pids and proc_info['pid'] not in target_pids:
-                            continue
-                        os.system(f"kill -9 {proc_info['pid']}")
-                        killed_pids.append(proc_info['pid'])
-            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess) as pe:
-                sys.stderr.write(str(pe))
+                proc = psutil.Process(int(pid))
+
+                if name in proc.name():
+                    proc.kill()
+                    killed_pids.append(proc.pid)
+            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess, ValueError) as pe:
+                self.app.log.debug(str(pe))
 
         if killed_pids:
             self.app.log.info(f"Killed processes {killed_pids}.")
@@ -109,3 +437,10 @@ class TestHandler(CommandHandler):
 
         with out_file.open(mode="a") as of:
             of.write(f"{test_outcome.name} {1 if test_outcome.passed else 0}\n")
+
+
+def _majority(attempts: List[Tuple[CommandData, TestOutcome]]) -> Union[bool, None]:
+    passed = sum(1 for _, outcome in attempts if outcome.passed)
+    failed = len(attempts) - passed
+
+    return None if passed == failed else passed > failed
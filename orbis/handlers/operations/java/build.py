@@ -8,18 +8,36 @@ class JavaBuildHandler(CommandHandler):
         label = "java_build"
 
     def build_maven(self, context: Context, env: dict = None) -> CommandData:
-        additional_args = "-DskipTests -Dhttps.protocols=TLSv1.2 -Denforcer.skip=true -Dcheckstyle.skip=true " \
-                          "-Dcobertura.skip=true -DskipITs=true -Drat.skip=true -Dlicense.skip=true -Dpmd.skip=true " \
-                          "-Dfindbugs.skip=true -Dgpg.skip=true -Dskip.npm=true -Dskip.gulp=true -Dskip.bower=true " \
-                          "-V -B"
-        cmd_data = CommandData(args=f"mvn install {additional_args}", cwd=str(context.root.resolve() / context.project.name), env=env)
+        cmd_data = self._maven_command(context, env)
         super().__call__(cmd_data=cmd_data, msg=f"Building {context.project.name}\n", raise_err=True)
         return cmd_data
 
+    async def abuild_maven(self, context: Context, env: dict = None) -> CommandData:
+        cmd_data = self._maven_command(context, env)
+        await self.acall(cmd_data=cmd_data, msg=f"Building {context.project.name}\n", raise_err=True)
+        return cmd_data
+
     def build_gradle(self, context: Context, env: dict = None) -> CommandData:
-        cmd_data = CommandData(args=f"./gradlew compileTestJava", cwd=str(context.root.resolve() / context.project.name), env=env)
+        cmd_data = self._gradle_command(context, env)
         super().__call__(cmd_data=cmd_data, msg=f"Building {context.project.name}\n", raise_err=True)
         return cmd_data
 
-    def save_outcome(self, cmd_data: CommandData, context: Context, tag: str = None):
+    async def abuild_gradle(self, context: Context, env: dict = None) -> CommandData:
+        cmd_data = self._gradle_command(context, env)
+        await self.acall(cmd_data=cmd_data, msg=f"Building {context.project.name}\n", raise_err=True)
+        return cmd_data
+
+    @staticmethod
+    def _maven_command(context: Context, env: dict = None) -> CommandData:
+        additional_args = "-DskipTests -Dhttps.protocols=TLSv1.2 -Denforcer.skip=true -Dcheckstyle.skip=true " \
+                          "-Dcobertura.skip=true -DskipITs=true -Drat.skip=true -Dlicense.skip=true -Dpmd.skip=true " \
+                          "-Dfindbugs.skip=true -Dgpg.skip=true -Dskip.npm=true -Dskip.gulp=true -Dskip.bower=true " \
+                          "-V -B"
+        return CommandData(args=f"mvn install {additional_args}", cwd=str(context.root.resolve() / context.project.name), env=env)
+
+    @staticmethod
+    def _gradle_command(context: Context, env: dict = None) -> CommandData:
+        return CommandData(args=f"./gradlew compileTestJava", cwd=str(context.root.resolve() / context.project.name), env=env)
+
+    def save_outcome(self, cmd_data: CommandData, context: Context, tag: str = None, args: dict = None):
         pass
\ No newline at end of file
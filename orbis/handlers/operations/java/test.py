@@ -87,6 +87,31 @@ class JavaTestHandler(CommandHandler):
         label = "java_test"
 
     def test_maven(self, context: Context, test: Test, env: dict = None) -> Tuple[CommandData, TestOutcome]:
+        cmd_data = self._maven_command(context, test, env)
+        super().__call__(cmd_data=cmd_data, msg=f"Testing {context.project.name}\n", raise_err=True)
+
+        return cmd_data, self._get_usage_outcome(context, test, cmd_data)
+
+    async def atest_maven(self, context: Context, test: Test, env: dict = None) -> Tuple[CommandData, TestOutcome]:
+        cmd_data = self._maven_command(context, test, env)
+        await self.acall(cmd_data=cmd_data, msg=f"Testing {context.project.name}\n", raise_err=True)
+
+        return cmd_data, self._get_usage_outcome(context, test, cmd_data)
+
+    def test_gradle(self, context: Context, test: Test, env: dict = None) -> Tuple[CommandData, TestOutcome]:
+        cmd_data = self._gradle_command(context, env)
+        super().__call__(cmd_data=cmd_data, msg=f"Testing {context.project.name}\n", raise_err=True)
+
+        return cmd_data, self._get_usage_outcome(context, test, cmd_data)
+
+    async def atest_gradle(self, context: Context, test: Test, env: dict = None) -> Tuple[CommandData, TestOutcome]:
+        cmd_data = self._gradle_command(context, env)
+        await self.acall(cmd_data=cmd_data, msg=f"Testing {context.project.name}\n", raise_err=True)
+
+        return cmd_data, self._get_usage_outcome(context, test, cmd_data)
+
+    @staticmethod
+    def _maven_command(context: Context, test: Test, env: dict = None) -> CommandData:
         # clean the old test results at first
         _read_test_results(context.root.resolve() / context.project.name)
         failing_module = context.project.modules['failing_module']
@@ -99,54 +124,40 @@ class JavaTestHandler(CommandHandler):
         test_cmd = f"mvn test -Dtest={test_name} {additional_args}" if failing_module == "root" \
             else f"mvn test -P{failing_module} -Dtest={test_name} {additional_args}"
 
-        cmd_data = CommandData(args=test_cmd, cwd=str(context.root.resolve() / context.project.name), env=env)
-        super().__call__(cmd_data=cmd_data, msg=f"Testing {context.project.name}\n", raise_err=True)
+        return CommandData(args=test_cmd, cwd=str(context.root.resolve() / context.project.name), env=env)
 
-        failed_tests, passed_tests = _read_test_results(context.root.resolve() / context.project.name)
-        for failed_test in failed_tests:
-            if failed_test == test_name:
-                outcome = TestOutcome(instance_id=context.instance.id, co_id=context.instance.pointer, name=test.id,
-                                      duration=round(cmd_data.duration, 3), exit_status=cmd_data.return_code,
-                                      error=cmd_data.error, passed=False)
-                return cmd_data, outcome
-
-        for passed_test in passed_tests:
-            if passed_test == test_name:
-                outcome = TestOutcome(instance_id=context.instance.id, co_id=context.instance.pointer, name=test.id,
-                                      duration=round(cmd_data.duration, 3), exit_status=cmd_data.return_code,
-                                      error=cmd_data.error, passed=True)
-                return cmd_data, outcome
-
-        return cmd_data, TestOutcome(instance_id=context.instance.id, co_id=context.instance.pointer, name=test.id,
-                                     duration=round(cmd_data.duration, 3), exit_status=cmd_data.return_code,
-                                     error="Test not found", passed=True)
-
-    def test_gradle(self, context: Context, test: Test, env: dict = None) -> Tuple[CommandData, TestOutcome]:
+    @staticmethod
+    def _gradle_command(context: Context, env: dict = None) -> CommandData:
         # clean the old test results at first
         _read_test_results(context.root.resolve() / context.project.name)
 
-        cmd_data = CommandData(args=f"./gradlew test", cwd=str(context.root.resolve() / context.project.name), env=env)
-        super().__call__(cmd_data=cmd_data, msg=f"Testing {context.project.name}\n", raise_err=True)
+        return CommandData(args=f"./gradlew test", cwd=str(context.root.resolve() / context.project.name), env=env)
 
+    def _get_usage_outcome(self, context: Context, test: Test, cmd_data: CommandData) -> TestOutcome:
+        outcome = self._get_outcome(context, test, cmd_data)
+        outcome.set_usage(cmd_data.usage)
+
+        return outcome
+
+    @staticmethod
+    def _get_outcome(context: Context, test: Test, cmd_data: CommandData) -> TestOutcome:
         test_name = test.file
         failed_tests, passed_tests = _read_test_results(context.root.resolve() / context.project.name)
         for failed_test in failed_tests:
             if failed_test == test_name:
-                outcome = TestOutcome(instance_id=context.instance.id, co_id=context.instance.pointer, name=test.id,
-                                      duration=round(cmd_data.duration, 3), exit_status=cmd_data.return_code,
-                                      error=cmd_data.error, passed=False)
-                return cmd_data, outcome
+                return TestOutcome(instance_id=context.instance.id, co_id=context.instance.pointer, name=test.id,
+                                   duration=round(cmd_data.duration, 3), exit_status=cmd_data.return_code,
+                                   error=cmd_data.error, passed=False)
 
         for passed_test in passed_tests:
             if passed_test == test_name:
-                outcome = TestOutcome(instance_id=context.instance.id, co_id=context.instance.pointer, name=test.id,
-                                      duration=round(cmd_data.duration, 3), exit_status=cmd_data.return_code,
-                                      error=cmd_data.error, passed=True)
-                return cmd_data, outcome
-
-        return cmd_data, TestOutcome(instance_id=context.instance.id, co_id=context.instance.pointer, name=test.id,
-                                     duration=round(cmd_data.duration, 3), exit_status=cmd_data.return_code,
-                                     error="Test not found", passed=True)
+                return TestOutcome(instance_id=context.instance.id, co_id=context.instance.pointer, name=test.id,
+                                   duration=round(cmd_data.duration, 3), exit_status=cmd_data.return_code,
+                                   error=cmd_data.error, passed=True)
+
+        return TestOutcome(instance_id=context.instance.id, co_id=context.instance.pointer, name=test.id,
+                           duration=round(cmd_data.duration, 3), exit_status=cmd_data.return_code,
+                           error="Test not found", passed=True)
 
     def save_outcome(self, cmd_data: CommandData, context: Context, tag: str = None):
         pass
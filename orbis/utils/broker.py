@@ -0,0 +1,120 @@
+import threading
+
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Set, Tuple
+
+# channels the output of the commands run in the current context is published to
+stream_channels: ContextVar[Tuple[str, ...]] = ContextVar('stream_channels', default=())
+
+
+@contextmanager
+def streaming(*channels: str):
+    """
+        Publishes the output of the commands run within the block to the channels (besides the channel of each command).
+    """
+    token = stream_channels.set(stream_channels.get() + channels)
+
+    try:
+        yield
+    finally:
+        stream_channels.reset(token)
+
+
+class Subscription:
+    """
+        Bounded queue of the events of a channel for a subscriber. When the subscriber does not keep up, the oldest
+        events are dropped, so that publishing never blocks the command producing them.
+    """
+
+    def __init__(self, channel: str, max_size: int = 1000):
+        self.channel = channel
+        self.dropped = 0
+        self.closed = False
+        self._events = deque(maxlen=max_size)
+        self._cond = threading.Condition()
+
+    def put(self, event: dict):
+        with self._cond:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1
+
+            self._events.append(event)
+            self._cond.notify()
+
+    def get(self, timeout: float = None) -> Tuple[List[dict], int]:
+        """
+            Waits for events and returns them with the number of events dropped since the last call.
+        """
+        with self._cond:
+            if not self._events and not self.closed:
+                self._cond.wait(timeout)
+
+            events = list(self._events)
+            self._events.clear()
+            dropped, self.dropped = self.dropped, 0
+
+            return events, dropped
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+
+class OutputBroker:
+    """
+        Fans out the events of the running commands (start, output lines, end) to the subscribers of their channels,
+        and keeps track of the channels of the commands still running.
+    """
+
+    def __init__(self):
+        self._subscriptions: Dict[str, Set[Subscription]] = {}
+        # channels of the commands that are running
+        self._live: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def started(self, channel: str):
+        with self._lock:
+            self._live.add(channel)
+
+    def ended(self, channel: str):
+        with self._lock:
+            self._live.discard(channel)
+
+    def is_live(self, channel: str) -> bool:
+        with self._lock:
+            return channel in self._live
+
+    def subscribe(self, channel: str, max_size: int = 1000) -> Subscription:
+        subscription = Subscription(channel, max_size=max_size)
+
+        with self._lock:
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscription.close()
+
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel, set())
+            subscriptions.discard(subscription)
+
+            if not subscriptions:
+                self._subscriptions.pop(subscription.channel, None)
+
+    def publish(self, channels: Iterable[str], event: dict):
+        with self._lock:
+            subscriptions = [s for channel in channels for s in self._subscriptions.get(channel, ())]
+
+        for subscription in subscriptions:
+            subscription.put(event)
+
+
+_broker = OutputBroker()
+
+
+def get_broker() -> OutputBroker:
+    return _broker
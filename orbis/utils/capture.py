@@ -0,0 +1,195 @@
+import asyncio
+import os
+import selectors
+import tempfile
+
+from collections import deque
+from typing import Callable, IO, Dict
+
+
+def _last(content: bytes, size: int) -> bytes:
+    # content[-0:] would be the whole content
+    return content[-size:] if size > 0 else b''
+
+
+class StreamBuffer:
+    """
+        Bounded capture of an output stream. The content is kept in memory up to the spill size, after which the full
+        content goes to a temporary file and only the head and a ring buffer with the tail are kept in memory. The
+        file is removed when the buffer is discarded, unless it is kept for the full content.
+    """
+
+    def __init__(self, spill_size: int = 1 << 20, head_size: int = 1 << 14, tail_size: int = 1 << 16,
+                 prefix: str = 'orbis-', keep_file: bool = False):
+        self.spill_size = spill_size
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.prefix = prefix
+        self.keep_file = keep_file
+        self.size = 0
+        self.file: str = None
+        self._chunks = []
+        self._head = b''
+        self._tail = deque()
+        self._tail_size = 0
+        self._stream: IO = None
+
+    @property
+    def spilled(self) -> bool:
+        return self.file is not None
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+
+        if not self.spilled:
+            self._chunks.append(chunk)
+
+            if self.size > self.spill_size:
+                self._spill()
+
+            return
+
+        self._stream.write(chunk)
+
+        if self.tail_size <= 0:
+            return
+
+        self._tail.append(chunk)
+        self._tail_size += len(chunk)
+
+        # drops the oldest chunks while the remaining ones cover the tail
+        while self._tail and self._tail_size - len(self._tail[0]) >= self.tail_size:
+            self._tail_size -= len(self._tail.popleft())
+
+    def _spill(self):
+        fd, self.file = tempfile.mkstemp(prefix=self.prefix, suffix='.log')
+        self._stream = os.fdopen(fd, mode='wb')
+        content = b''.join(self._chunks)
+        self._chunks = []
+        self._stream.write(content)
+        self._head = content[:self.head_size]
+        self._tail.append(_last(content, self.tail_size))
+        self._tail_size = len(self._tail[0])
+
+    def close(self):
+        if self._stream:
+            self._stream.close()
+            self._stream = None
+
+    def discard(self):
+        """
+            Closes the buffer and removes its spilled file. The summary of the content is still available.
+        """
+        self.close()
+
+        if self.spilled and os.path.exists(self.file):
+            os.remove(self.file)
+
+    def getvalue(self) -> bytes:
+        """
+            Returns the content, or a summary with the head and the tail if the content was spilled.
+        """
+        if not self.spilled:
+            return b''.join(self._chunks)
+
+        # the tail leaves out the bytes already in the head
+        tail = _last(b''.join(self._tail), min(self.tail_size, self.size - len(self._head)))
+        skipped = max(self.size - len(self._head) - len(tail), 0)
+        kept = f", full output in {self.file}" if self.keep_file else ''
+        note = f"\n[... {skipped} bytes skipped{kept} ...]\n".encode()
+
+        return self._head + note + tail
+
+    def text(self) -> str:
+        return self.getvalue().decode(errors='replace')
+
+
+class LineSplitter:
+    """
+        Splits the chunks of a stream into decoded lines for a callback. Lines are not buffered past the limit.
+    """
+
+    def __init__(self, callback: Callable[[str], None], limit: int = 1 << 16):
+        self.callback = callback
+        self.limit = limit
+        self._partial = b''
+
+    def feed(self, chunk: bytes):
+        *lines, self._partial = (self._partial + chunk).split(b'\n')
+
+        for line in lines:
+            self.callback(line.decode(errors='replace') + '\n')
+
+        if len(self._partial) > self.limit:
+            self.flush()
+
+    def flush(self):
+        if self._partial:
+            self.callback(self._partial.decode(errors='replace'))
+            self._partial = b''
+
+
+def drain(streams: Dict[IO, StreamBuffer], on_line: Dict[IO, Callable[[str], None]] = None, chunk_size: int = 1 << 16):
+    """
+        Reads the streams at the same time into the buffers until all of them are closed, so that a full pipe never
+        blocks the process writing to the others.
+
+        :param streams: the pipes with the buffers that capture them
+        :param on_line: callbacks for the decoded lines of the streams
+        :param chunk_size: maximum number of bytes read at once
+    """
+    splitters = {stream: LineSplitter(callback, chunk_size) for stream, callback in (on_line or {}).items()}
+
+    with selectors.DefaultSelector() as selector:
+        for stream in streams:
+            selector.register(stream, selectors.EVENT_READ)
+
+        while selector.get_map():
+            for key, _ in selector.select():
+                stream = key.fileobj
+                chunk = os.read(stream.fileno(), chunk_size)
+
+                if not chunk:
+                    selector.unregister(stream)
+
+                    if stream in splitters:
+                        splitters[stream].flush()
+
+                    continue
+
+                streams[stream].write(chunk)
+
+                if stream in splitters:
+                    splitters[stream].feed(chunk)
+
+    for buffer in streams.values():
+        buffer.close()
+
+
+async def adrain(streams: Dict[asyncio.StreamReader, StreamBuffer],
+                 on_line: Dict[asyncio.StreamReader, Callable[[str], None]] = None, chunk_size: int = 1 << 16):
+    """
+        Async counterpart of drain, for the streams of a process started with asyncio.
+    """
+    on_line = on_line if on_line else {}
+
+    async def read(stream: asyncio.StreamReader, buffer: StreamBuffer):
+        splitter = LineSplitter(on_line[stream], chunk_size) if stream in on_line else None
+
+        while True:
+            chunk = await stream.read(chunk_size)
+
+            if not chunk:
+                break
+
+            buffer.write(chunk)
+
+            if splitter:
+                splitter.feed(chunk)
+
+        if splitter:
+            splitter.flush()
+
+        buffer.close()
+
+    await asyncio.gather(*[read(stream, buffer) for stream, buffer in streams.items()])
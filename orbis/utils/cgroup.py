@@ -0,0 +1,164 @@
+import os
+import signal
+import time
+import uuid
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from orbis.data.results import Usage
+
+CONTROLLERS = {'memory.max': 'memory', 'cpu.max': 'cpu', 'pids.max': 'pids'}
+
+# the roots checked so far, None for the ones that can not be used
+_roots: Dict[str, Optional[Path]] = {}
+
+
+@dataclass
+class CGroupLimits:
+    """
+        Data object for the limits of the cgroups of the commands, in the format of the cgroup files: memory_max in
+        bytes (or with the K, M, G suffixes), cpu_max as "$QUOTA $PERIOD" in microseconds, and pids_max as the number
+        of tasks.
+    """
+    memory_max: str = None
+    cpu_max: str = None
+    pids_max: int = None
+
+    def files(self) -> Dict[str, str]:
+        limits = {'memory.max': self.memory_max, 'cpu.max': self.cpu_max, 'pids.max': self.pids_max}
+
+        return {file: str(value) for file, value in limits.items() if value is not None}
+
+
+def delegated_root(root: str = None, limits: CGroupLimits = None,
+                   log: Callable[[str], None] = None) -> Optional[Path]:
+    """
+        Returns the cgroup under which the cgroups of the commands are created, if it is a cgroup v2 delegated to the
+        user running orbis, with the controllers for the limits enabled for its children. Otherwise, returns None.
+        The root must be given: the cgroup of orbis can not be used, as it holds processes (no internal processes rule).
+
+        :param root: path of the cgroup
+        :param limits: the limits that the cgroups of the commands must support
+        :param log: callback for the reason the root can not be used, called only on the first check
+    """
+    needed = {CONTROLLERS[file] for file in limits.files()} if limits else set()
+    key = f"{root}:{sorted(needed)}"
+
+    if key in _roots:
+        return _roots[key]
+
+    path = Path(root).expanduser() if root else None
+    reason = None
+
+    if path is None:
+        reason = "no cgroup root is configured"
+    elif not (path / 'cgroup.controllers').exists():
+        reason = f"{path} is not a cgroup v2"
+    elif not os.access(str(path), os.W_OK) or not os.access(str(path / 'cgroup.subtree_control'), os.W_OK):
+        reason = f"{path} is not delegated to the current user"
+    elif not needed <= set((path / 'cgroup.controllers').read_text().split()):
+        reason = f"the controllers {sorted(needed)} are not all available in {path}"
+    else:
+        missing = needed - set((path / 'cgroup.subtree_control').read_text().split())
+
+        try:
+            if missing:
+                (path / 'cgroup.subtree_control').write_text(' '.join(f"+{c}" for c in sorted(missing)))
+        except OSError as e:
+            # e.g., the root has processes of its own (no internal processes rule)
+            reason = f"could not enable the controllers {sorted(missing)} in {path}: {e.strerror}"
+
+    if reason and log:
+        log(f"Running commands without cgroup limits: {reason}.")
+
+    _roots[key] = None if reason else path
+
+    return _roots[key]
+
+
+class CGroup:
+    """
+        Transient cgroup of a command. The command is moved into the cgroup before it is executed, and when it ends the
+        usage is read back, the remaining processes are killed and the cgroup removed (which can take a while, the
+        async commands remove it in the executor).
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    @staticmethod
+    def create(root: Path, limits: CGroupLimits) -> 'CGroup':
+        cgroup = CGroup(root / f"orbis-{uuid.uuid4().hex[:12]}")
+        cgroup.path.mkdir()
+
+        try:
+            for file, value in limits.files().items():
+                (cgroup.path / file).write_text(value)
+        except OSError:
+            cgroup.path.rmdir()
+            raise
+
+        return cgroup
+
+    def wrap(self, args: List[str]) -> List[str]:
+        """
+            Returns the argv that runs the command in the cgroup, the way cgexec does: a shell moves itself into the
+            cgroup and then execs the command, so that no code runs in the child between the fork and the exec.
+        """
+        return ['/bin/sh', '-c', 'echo $$ > "$1" && shift && exec "$@"', 'sh', str(self.path / 'cgroup.procs'), *args]
+
+    def _read(self, file: str) -> Dict[str, int]:
+        try:
+            content = (self.path / file).read_text().split()
+        except OSError:
+            return {}
+
+        if len(content) == 1:
+            return {file: int(content[0])}
+
+        return {key: int(value) for key, value in zip(content[::2], content[1::2])}
+
+    def update(self, usage: Usage):
+        """
+            Sets the usage with the accounting of the cgroup, which covers all the processes of the command.
+        """
+        cpu = self._read('cpu.stat')
+
+        if 'user_usec' in cpu:
+            usage.user_time = cpu['user_usec'] / 1e6
+            usage.sys_time = cpu['system_usec'] / 1e6
+
+        usage.memory_peak = self._read('memory.peak').get('memory.peak', None)
+        usage.oom_kills = self._read('memory.events').get('oom_kill', None)
+
+    def close(self, timeout: float = 1):
+        """
+            Kills the processes left in the cgroup and removes it.
+        """
+        kill_file = self.path / 'cgroup.kill'
+
+        try:
+            if kill_file.exists():
+                kill_file.write_text('1')
+            else:
+                for pid in (self.path / 'cgroup.procs').read_text().split():
+                    os.kill(int(pid), signal.SIGKILL)
+        except (OSError, ValueError):
+            pass
+
+        deadline = time.monotonic() + timeout
+
+        # the cgroup can only be removed after the killed processes are gone
+        while True:
+            try:
+                self.path.rmdir()
+                return
+            except FileNotFoundError:
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    return
+
+                time.sleep(0.01)
@@ -0,0 +1,43 @@
+import os
+import subprocess
+
+from pathlib import Path
+from typing import List, Union
+
+from orbis.data.snapshot import content_hash
+
+
+def _git(source: Path, *args: str) -> bytes:
+    return subprocess.run(['git', *args], cwd=str(source), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                          check=True).stdout
+
+
+def _excluded(path: Path, exclude: List[Path]) -> bool:
+    return any(path == excluded or excluded in path.parents for excluded in exclude)
+
+
+def source_fingerprint(source: Path, exclude: List[Path] = None) -> str:
+    """
+        Returns the fingerprint of the content of the source tree. For git repositories, it covers the commit, the
+        changes to the tracked files and the untracked (not ignored) files; otherwise, the content of all the files.
+
+        :param source: the root of the source tree
+        :param exclude: directories left out of the untracked files (e.g., the build directory)
+    """
+    source = Path(source).resolve()
+    exclude = [Path(p).resolve() for p in (exclude or [])]
+    parts: List[Union[str, bytes, Path]] = []
+
+    try:
+        parts.extend([_git(source, 'rev-parse', 'HEAD'), _git(source, 'diff', 'HEAD', '--binary')])
+        untracked = _git(source, 'ls-files', '--others', '--exclude-standard', '-z').decode(errors='replace')
+        files = [source / f for f in untracked.split('\0') if f]
+        kind = 'git'
+    except (subprocess.CalledProcessError, OSError):
+        files = [Path(root, name) for root, _, names in os.walk(str(source)) for name in names]
+        kind = 'tree'
+
+    for file in sorted(f for f in files if not _excluded(f, exclude)):
+        parts.extend([str(file.relative_to(source)), os.readlink(str(file)) if file.is_symlink() else file])
+
+    return f"{kind}:{content_hash(*parts)}"
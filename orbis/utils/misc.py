@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import List
+from typing import List, Tuple, Dict, Optional
 import fileinput
 
 
@@ -41,4 +41,29 @@ def collect_coverage(out_dir: Path, cov_dir: Path, cov_suffix: str, rename_suffi
                 for line in fin:
                     fout.write(line)
             # delete the file generated
-            in_file.unlink()
\ No newline at end of file
+            in_file.unlink()
+
+
+class PathIndex:
+    """
+        Index of a list of (file, value) pairs by file name, to look up the files ending with a relative path.
+    """
+
+    def __init__(self, files: List[Tuple[str, str]]):
+        self.files = files
+        self._names: Dict[str, List[int]] = {}
+
+        for pos, (file, _) in enumerate(files):
+            self._names.setdefault(file.rsplit('/', 1)[-1], []).append(pos)
+
+    def find(self, short_path: str) -> Optional[Tuple[str, str]]:
+        """
+            Returns the first pair whose file ends with the relative path, matching whole path components.
+        """
+        for pos in self._names.get(short_path.rsplit('/', 1)[-1], []):
+            file = self.files[pos][0]
+
+            if file == short_path or file.endswith('/' + short_path):
+                return self.files[pos]
+
+        return None
@@ -0,0 +1,114 @@
+import asyncio
+import os
+import threading
+import warnings
+
+from typing import Callable, Dict, Optional, Tuple
+
+from orbis.data.results import Usage
+
+
+def exit_code(status: int) -> int:
+    """
+        Decodes the wait status the way Popen does: the exit code, or the negative signal number.
+    """
+    if hasattr(os, 'waitstatus_to_exitcode'):
+        return os.waitstatus_to_exitcode(status)
+
+    return -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+
+# child watchers are gone since python 3.14, where the asyncio subprocesses are reaped without their usage
+_ChildWatcher = getattr(asyncio, 'AbstractChildWatcher', object)
+
+
+class RusageChildWatcher(_ChildWatcher):
+    """
+        Child watcher for the asyncio subprocesses that reaps them with wait4 when their pidfd becomes readable, so
+        that their resource usage is kept, without a thread per process. The usage is kept until it is popped.
+    """
+
+    def __init__(self):
+        self._callbacks: Dict[int, Tuple[int, Callable, tuple]] = {}
+        self._usages: Dict[int, Usage] = {}
+
+    def add_child_handler(self, pid: int, callback: Callable, *args):
+        loop = asyncio.get_running_loop()
+        pidfd = os.pidfd_open(pid)
+        self._callbacks[pid] = (pidfd, callback, args)
+        loop.add_reader(pidfd, self._reap, loop, pid)
+
+    def remove_child_handler(self, pid: int) -> bool:
+        if pid not in self._callbacks:
+            return False
+
+        pidfd, _, _ = self._callbacks.pop(pid)
+        asyncio.get_running_loop().remove_reader(pidfd)
+        os.close(pidfd)
+
+        return True
+
+    def pop_usage(self, pid: int) -> Optional[Usage]:
+        return self._usages.pop(pid, None)
+
+    def _reap(self, loop: asyncio.AbstractEventLoop, pid: int):
+        pidfd, callback, args = self._callbacks.pop(pid)
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+
+        try:
+            _, status, rusage = os.wait4(pid, 0)
+        except ChildProcessError:
+            # reaped elsewhere, reported the way the asyncio watchers do
+            returncode = 255
+        else:
+            returncode = exit_code(status)
+            self._usages[pid] = Usage.from_rusage(rusage)
+
+        callback(pid, returncode, *args)
+
+    def attach_loop(self, loop: asyncio.AbstractEventLoop):
+        pass
+
+    def is_active(self) -> bool:
+        return True
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_watcher: Optional[RusageChildWatcher] = None
+_watcher_lock = threading.Lock()
+
+
+def get_watcher() -> Optional[RusageChildWatcher]:
+    """
+        Installs the rusage child watcher for the asyncio subprocesses of the process, once. Returns None when pidfds
+        or child watchers are not supported, in which case the subprocesses are reaped by asyncio without their usage.
+    """
+    global _watcher
+
+    with _watcher_lock:
+        if _watcher is None:
+            if _ChildWatcher is object or not hasattr(os, 'pidfd_open'):
+                return None
+
+            try:
+                os.close(os.pidfd_open(os.getpid()))
+            except OSError:
+                return None
+
+            _watcher = RusageChildWatcher()
+
+            with warnings.catch_warnings():
+                # child watchers are deprecated since python 3.12
+                warnings.simplefilter('ignore', DeprecationWarning)
+                asyncio.set_child_watcher(_watcher)
+
+        return _watcher
@@ -0,0 +1,101 @@
+import heapq
+import itertools
+import sys
+import threading
+import time
+
+from typing import Callable
+
+
+class Timeout:
+    """
+        Handle of a scheduled callback.
+    """
+
+    def __init__(self, deadline: float, callback: Callable[[], None]):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+        self.fired = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+        Single thread running the scheduled callbacks in deadline order, shared by all the running commands instead of
+        a timer thread per command. Failing callbacks are reported to the log, when set.
+    """
+
+    def __init__(self, log=None):
+        self.log = log
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread: threading.Thread = None
+
+    def schedule(self, delay: float, callback: Callable[[], None]) -> Timeout:
+        """
+            Schedules the callback to run after the delay (in seconds).
+        """
+        timeout = Timeout(time.monotonic() + delay, callback)
+
+        with self._cond:
+            heapq.heappush(self._heap, (timeout.deadline, next(self._counter), timeout))
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='orbis-scheduler', daemon=True)
+                self._thread.start()
+
+            self._cond.notify()
+
+        return timeout
+
+    def __len__(self):
+        with self._cond:
+            return sum(1 for _, _, t in self._heap if not t.cancelled)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # drops the cancelled callbacks at the top, so they do not delay the wake up
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                delay = self._heap[0][0] - time.monotonic()
+
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                _, _, timeout = heapq.heappop(self._heap)
+
+            if not timeout.cancelled:
+                timeout.fired = True
+
+                try:
+                    timeout.callback()
+                except Exception as e:
+                    # a failing callback must not stop the timeouts of the other commands
+                    if self.log is not None:
+                        self.log.error(f"Scheduled callback failed: {e}")
+                    else:
+                        sys.stderr.write(f"Scheduled callback failed: {e}\n")
+
+
+_scheduler = Scheduler()
+
+
+def get_scheduler(log=None) -> Scheduler:
+    """
+        Returns the scheduler of the process, reporting the failing callbacks to the log if supplied.
+    """
+    if log is not None:
+        _scheduler.log = log
+
+    return _scheduler
@@ -0,0 +1,75 @@
+import os
+
+from orbis.utils.capture import StreamBuffer, LineSplitter
+
+
+def summary(buffer: StreamBuffer) -> bytes:
+    buffer.discard()
+
+    assert not os.path.exists(buffer.file)
+
+    return buffer.getvalue()
+
+
+def test_stream_buffer_memory():
+    buffer = StreamBuffer(spill_size=10)
+    buffer.write(b'abc')
+    buffer.write(b'def')
+
+    assert not buffer.spilled
+    assert buffer.getvalue() == b'abcdef'
+
+
+def test_stream_buffer_spill():
+    buffer = StreamBuffer(spill_size=4, head_size=2, tail_size=3)
+
+    for chunk in [b'ab', b'cd', b'ef', b'gh', b'ij']:
+        buffer.write(chunk)
+
+    buffer.close()
+
+    with open(buffer.file, mode='rb') as stream:
+        assert stream.read() == b'abcdefghij'
+
+    value = summary(buffer)
+    assert value.startswith(b'ab\n[... 5 bytes skipped') and value.endswith(b'...]\nhij')
+
+
+def test_stream_buffer_keep_file():
+    buffer = StreamBuffer(spill_size=4, head_size=2, tail_size=2, keep_file=True)
+    buffer.write(b'abcdef')
+    buffer.close()
+
+    try:
+        assert f"full output in {buffer.file}".encode() in buffer.getvalue()
+    finally:
+        buffer.discard()
+
+
+def test_stream_buffer_no_tail():
+    buffer = StreamBuffer(spill_size=4, head_size=2, tail_size=0)
+
+    for chunk in [b'abc', b'def', b'ghi']:
+        buffer.write(chunk)
+
+    assert summary(buffer).startswith(b'ab\n[... 7 bytes skipped') and buffer.getvalue().endswith(b'...]\n')
+
+
+def test_stream_buffer_overlap():
+    # the head and the tail cover the whole content, nothing is repeated nor skipped
+    buffer = StreamBuffer(spill_size=4, head_size=4, tail_size=4)
+    buffer.write(b'abcdef')
+
+    value = summary(buffer)
+    assert value.startswith(b'abcd\n[... 0 bytes skipped') and value.endswith(b'...]\nef')
+
+
+def test_line_splitter():
+    lines = []
+    splitter = LineSplitter(lines.append, limit=4)
+    splitter.feed(b'ab\ncd')
+    splitter.feed(b'e\nfghij')
+    splitter.feed(b'k')
+    splitter.flush()
+
+    assert lines == ['ab\n', 'cde\n', 'fghij', 'k']
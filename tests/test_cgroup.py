@@ -0,0 +1,21 @@
+import subprocess
+
+from orbis.utils.cgroup import CGroup, CGroupLimits, delegated_root
+
+
+def test_cgroup_wrap(tmp_path):
+    # the wrapper writes its own pid, which the command keeps after the exec
+    (tmp_path / 'cgroup.procs').write_text('')
+    args = CGroup(tmp_path).wrap(['/bin/sh', '-c', 'echo $$; printf "%s|" "$@"', 'sh', 'a b', 'c'])
+    pid, output = subprocess.run(args, stdout=subprocess.PIPE, text=True, check=True).stdout.split('\n')
+
+    assert (tmp_path / 'cgroup.procs').read_text().strip() == pid
+    assert output == 'a b|c|'
+
+
+def test_cgroup_root_required(tmp_path):
+    reasons = []
+
+    assert delegated_root(None, limits=CGroupLimits(pids_max=10), log=reasons.append) is None
+    assert delegated_root(str(tmp_path), log=reasons.append) is None
+    assert 'no cgroup root' in reasons[0] and 'not a cgroup v2' in reasons[1]
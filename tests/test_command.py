@@ -0,0 +1,128 @@
+import asyncio
+import signal
+import subprocess
+import tempfile
+
+from pathlib import Path
+
+from types import SimpleNamespace
+
+from orbis.data.results import CommandData
+from orbis.handlers.command import CommandHandler, CommandTimer
+from orbis.utils.broker import get_broker, streaming
+from orbis.utils.reaper import get_watcher
+
+
+class Log:
+    def __init__(self):
+        self.errors = []
+
+    def error(self, msg: str, *args):
+        self.errors.append(msg)
+
+    def info(self, *args):
+        pass
+
+    debug = warning = info
+
+
+def get_handler(**config) -> CommandHandler:
+    handler = CommandHandler()
+    handler.app = SimpleNamespace(get_config=lambda key: config.get(key, None), pargs=SimpleNamespace(verbose=False),
+                                  log=Log())
+
+    return handler
+
+
+def test_command_no_shebang(tmp_path):
+    # scripts without a shebang are run by the shell, as execvp does
+    script = tmp_path / 'noshebang.sh'
+    script.write_text('echo "$1 from script"\n')
+    script.chmod(0o755)
+    cmd_data = get_handler()(CommandData(args='./noshebang.sh hello', cwd=str(tmp_path)))
+
+    assert cmd_data.error is None
+    assert cmd_data.output == 'hello from script\n'
+
+
+def test_command_spawn_errors(tmp_path):
+    handler = get_handler()
+    not_found = handler(CommandData(args='orbis-missing-program --version'))
+    not_executable = handler(CommandData(args=[str(tmp_path)]))
+    not_a_dir = handler(CommandData(args='true', cwd=str(tmp_path / 'missing')))
+
+    assert not_found.return_code == 127 and 'orbis-missing-program' in not_found.error
+    assert not_executable.return_code == 126 and not_executable.error
+    assert not_a_dir.return_code == 127 and not_a_dir.error
+
+
+def test_command_shell():
+    handler = get_handler()
+
+    assert handler(CommandData(args='echo a | tr a b')).output == 'b\n'
+    assert handler(CommandData(args=['echo', 'a | tr a b'])).output == 'a | tr a b\n'
+    assert handler(CommandData(args='exit 3')).return_code == 3
+
+
+def test_command_acall():
+    cmd_data = asyncio.run(get_handler().acall(CommandData(args='echo out; echo err >&2; exit 2')))
+
+    assert cmd_data.return_code == 2
+    assert cmd_data.output == 'out\n' and cmd_data.error == 'err\n'
+    assert cmd_data.usage is not None or get_watcher() is None
+
+
+def spilled_files(tmp_path) -> list:
+    return sorted(path.name for path in tmp_path.iterdir())
+
+
+def test_command_spilled_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    capture = {'spill_size': 4, 'head_size': 2, 'tail_size': 2}
+    args = 'echo output; echo error >&2; exit 1'
+
+    # the spilled outputs are removed once the command ends
+    cmd_data = get_handler(capture=capture)(CommandData(args=args))
+    other = asyncio.run(get_handler(capture=capture).acall(CommandData(args=args)))
+
+    assert cmd_data.output.startswith('ou') and cmd_data.output_file is None and other.error_file is None
+    assert spilled_files(tmp_path) == []
+
+    # unless they are kept, the error of a command that timed out is not
+    cmd_data = get_handler(capture={**capture, 'keep_file': True})(CommandData(args=args))
+    timed_out = get_handler(capture={**capture, 'keep_file': True})(
+        CommandData(args='echo output; echo error >&2; sleep 5', timeout=0.2))
+
+    assert spilled_files(tmp_path) == sorted(Path(file).name for file in [cmd_data.output_file, cmd_data.error_file,
+                                                                           timed_out.output_file])
+    assert timed_out.error == 'Command timed out' and timed_out.error_file is None
+
+
+def test_command_timer_cancel():
+    # the command exits on SIGTERM, the SIGKILL after the grace period must not be sent to a reused group id
+    proc = subprocess.Popen(['sleep', '10'], start_new_session=True)
+    cmd_data = CommandData(args='sleep 10', pid=proc.pid, pgid=proc.pid, timeout=0.1)
+    timer = CommandTimer(proc, cmd_data, grace=10)
+    proc.wait()
+    timer.cancel()
+
+    assert proc.returncode == -signal.SIGTERM and cmd_data.error == 'Command timed out'
+    assert timer.kill is not None and timer.kill.cancelled
+
+
+def test_command_events():
+    broker = get_broker()
+    subscription = broker.subscribe('instance:test')
+
+    try:
+        with streaming('instance:test'):
+            cmd_data = get_handler()(CommandData(args='echo line'))
+    finally:
+        broker.unsubscribe(subscription)
+
+    events, _ = subscription.get(timeout=0)
+
+    assert [event['event'] for event in events] == ['start', 'line', 'end']
+    assert all(event['id'] == cmd_data.cmd_id for event in events)
+    # the channel of the command is not live once it ended, its stream would not wait for events
+    assert not broker.is_live(f"command:{cmd_data.cmd_id}")
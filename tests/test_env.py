@@ -0,0 +1,45 @@
+import os
+import pytest
+
+from types import SimpleNamespace
+
+from orbis.data.env import EnvOverlay, materialize
+from orbis.handlers.benchmark.benchmark import BenchmarkHandler
+
+
+def test_env_overlay_unchanged():
+    env = EnvOverlay()
+
+    assert env.materialize() is None and materialize(env.child()) is None
+    assert dict(env) == dict(os.environ)
+
+
+def test_env_overlay_child():
+    parent = EnvOverlay(deltas={'ORBIS_A': '1', 'ORBIS_B': '2'})
+    child = parent.child({'ORBIS_A': '3'})
+    del child['ORBIS_B']
+    child['ORBIS_C'] = 4
+
+    assert child['ORBIS_A'] == '3' and 'ORBIS_B' not in child and child['ORBIS_C'] == '4'
+    assert parent['ORBIS_A'] == '1' and parent['ORBIS_B'] == '2' and 'ORBIS_C' not in parent
+
+    env = child.materialize()
+
+    assert env['ORBIS_A'] == '3' and 'ORBIS_B' not in env and env['ORBIS_C'] == '4'
+    assert 'PATH' not in os.environ or env['PATH'] == os.environ['PATH']
+
+
+def test_env_overlay_unset_missing():
+    with pytest.raises(KeyError):
+        del EnvOverlay()['ORBIS_MISSING']
+
+
+def test_benchmark_get_env():
+    # the commands get a copy of the variables of the handler, the later changes do not reach them
+    handler = SimpleNamespace(env=EnvOverlay(deltas={'ORBIS_A': '1'}))
+    env = BenchmarkHandler.get_env(handler, ORBIS_B='2')
+    env['ORBIS_C'] = '3'
+    handler.env['ORBIS_A'] = '4'
+
+    assert env['ORBIS_A'] == '1' and env['ORBIS_B'] == '2'
+    assert 'ORBIS_B' not in handler.env and 'ORBIS_C' not in handler.env
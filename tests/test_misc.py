@@ -0,0 +1,11 @@
+from orbis.utils.misc import PathIndex
+
+
+def test_path_index_find():
+    index = PathIndex([('/x/ba/main.c', 'o1'), ('/x/a/main.c', 'o2'), ('util.c', 'o3')])
+
+    assert index.find('a/main.c') == ('/x/a/main.c', 'o2')
+    assert index.find('main.c') == ('/x/ba/main.c', 'o1')
+    assert index.find('util.c') == ('util.c', 'o3')
+    assert index.find('c/main.c') is None
+    assert index.find('in.c') is None
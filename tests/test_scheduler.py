@@ -0,0 +1,50 @@
+import threading
+
+from orbis.utils.scheduler import Scheduler
+
+
+class Log:
+    def __init__(self):
+        self.errors = []
+
+    def error(self, msg: str):
+        self.errors.append(msg)
+
+
+def test_scheduler_order():
+    scheduler = Scheduler()
+    fired, done = [], threading.Event()
+
+    # scheduled out of order, fired by deadline
+    scheduler.schedule(0.2, lambda: (fired.append(3), done.set()))
+    scheduler.schedule(0.05, lambda: fired.append(1))
+    scheduler.schedule(0.1, lambda: fired.append(2))
+
+    assert done.wait(2)
+    assert fired == [1, 2, 3]
+    assert len(scheduler) == 0
+
+
+def test_scheduler_cancel():
+    scheduler = Scheduler()
+    fired, done = [], threading.Event()
+    cancelled = scheduler.schedule(0.05, lambda: fired.append('cancelled'))
+    timeout = scheduler.schedule(0.1, lambda: (fired.append('fired'), done.set()))
+    cancelled.cancel()
+
+    assert len(scheduler) == 1
+    assert done.wait(2)
+    assert fired == ['fired']
+    assert timeout.fired and not cancelled.fired
+
+
+def test_scheduler_failing_callback():
+    # a failing callback is logged and does not stop the others
+    log = Log()
+    scheduler = Scheduler(log=log)
+    done = threading.Event()
+    scheduler.schedule(0.01, lambda: 1 / 0)
+    scheduler.schedule(0.05, done.set)
+
+    assert done.wait(2)
+    assert len(log.errors) == 1 and 'division by zero' in log.errors[0]
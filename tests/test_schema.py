@@ -0,0 +1,76 @@
+import os
+
+from copy import deepcopy
+
+from pytest import raises
+from schema import SchemaError
+
+from orbis.data.schema import Project, get_oracle, parse_oracle
+
+ORACLE = {
+    'script': 'run.sh',
+    'cwd': 'tests',
+    'generator': {'script': 'gen.sh', 'path': 'out'},
+    'cases': {
+        'test_1': {'order': 1, 'file': 'test_1.sh', 'timeout': 10},
+        'test_2': {'order': 2, 'file': 'test_2.sh', 'args': '-v', 'cwd': 'sub', 'script': 'other.sh'},
+    }
+}
+
+
+def test_parse_oracle():
+    # the fast path builds the same objects as the schema
+    for is_pov in [False, True]:
+        assert parse_oracle(deepcopy(ORACLE), is_pov=is_pov) == get_oracle(is_pov=is_pov).validate(deepcopy(ORACLE))
+
+
+def test_parse_oracle_errors():
+    # invalid oracles raise the same errors as the schema
+    invalid = [{'cases': {}, 'script': 'run.sh'}, {'cases': {'t': {'order': True, 'file': 'f'}}, 'script': 'run.sh'},
+               {'cases': {'t': {'order': 1}}, 'script': 'run.sh'}, {**ORACLE, 'extra': 1}, {**ORACLE, 'cwd': None}]
+
+    for data in invalid:
+        with raises(SchemaError) as fast_error:
+            parse_oracle(deepcopy(data))
+
+        with raises(SchemaError) as schema_error:
+            get_oracle().validate(deepcopy(data))
+
+        assert str(fast_error.value) == str(schema_error.value)
+
+
+def test_oracle_select():
+    oracle = parse_oracle({'script': 'run.sh', 'cases': {f"test_{i}": {'order': i, 'file': f"test_{i}.sh"}
+                                                         for i in range(10, 0, -1)}})
+
+    assert list(oracle.copy(['test_3', 'test_1', 'unknown']).cases) == ['test_1', 'test_3']
+    assert list(oracle.copy(['5', '2']).cases) == ['test_2', 'test_5']
+    assert list(oracle.select(order_range=(4, 6)).cases) == ['test_4', 'test_5', 'test_6']
+    assert list(oracle.select(pattern='test_1*').cases) == ['test_1', 'test_10']
+    assert list(oracle.select(pattern=r'test_[23]$', regex=True).cases) == ['test_2', 'test_3']
+    assert len(oracle.copy([])) == 10
+
+
+def test_oracle_select_ties():
+    # the cases with the same order are sorted by their id, whatever the order they are selected in
+    oracle = parse_oracle({'script': 'run.sh', 'cases': {name: {'order': 1, 'file': f"{name}.sh"}
+                                                         for name in ['c', 'a', 'd', 'b']}})
+
+    assert list(oracle.copy(['d', 'b', 'c', 'a']).cases) == ['a', 'b', 'c', 'd']
+    assert list(oracle.select(orders=[1]).cases) == ['a', 'b', 'c', 'd']
+
+
+def test_project_oracle_reload(tmp_path):
+    # without the oracle cache, the oracle kept with the project is read again when its file changes
+    tests_file = tmp_path / 'tests.orbis.yaml'
+    tests_file.write_text("script: run.sh\ncases:\n  test_1: {order: 1, file: test_1.sh}\n")
+    project = Project(repo_path='repo', name='proj', path=tmp_path, id='p1', build=None, manifest=[], modules={},
+                      packages={}, patches={})
+
+    assert list(project.oracle.cases) == ['test_1']
+    assert project.oracle is project.oracle
+
+    tests_file.write_text("script: run.sh\ncases:\n  test_2: {order: 2, file: test_2.sh}\n")
+    os.utime(tests_file, ns=(0, 0))
+
+    assert list(project.oracle.cases) == ['test_2']
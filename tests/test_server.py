@@ -0,0 +1,24 @@
+import json
+
+from flask import Flask
+
+from orbis.ext.server import stream_json
+
+
+def fail():
+    raise ValueError('lost')
+
+
+def test_stream_json_error():
+    # the error is apart from the items, even those with the id 'error'
+    app = Flask(__name__)
+    items = [('error', lambda: {'id': 'error'}), ('e2', fail)]
+
+    with app.test_request_context():
+        body = ''.join(stream_json(iter(items)).response)
+        lines = ''.join(stream_json(iter(items), ndjson=True).response).splitlines()
+        empty = ''.join(stream_json(iter([])).response)
+
+    assert json.loads(body) == {'items': {'error': {'id': 'error'}}, 'error': 'lost'}
+    assert [json.loads(line) for line in lines] == [{'error': {'id': 'error'}}, {'error': 'lost'}]
+    assert empty == '{"items": {}}'
@@ -0,0 +1,282 @@
+import pytest
+import tempfile
+import time
+
+from pathlib import Path
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
+
+from orbis.data.results import CommandData
+from orbis.data.schema import parse_oracle
+# aliased, so that pytest does not collect them
+from orbis.ext.database import Base, Database, OutcomeWriter, TestOutcome as Outcome
+from orbis.handlers.operations.c.make import build_flags
+from orbis.handlers.operations.c.test import TestHandler as Handler, _majority
+from orbis.utils.broker import get_broker, streaming
+
+
+class Log:
+    def __init__(self):
+        self.messages = []
+
+    def info(self, msg: str, *args):
+        self.messages.append(msg)
+
+    debug = warning = error = info
+
+
+@pytest.fixture
+def db() -> Database:
+    db = Database.__new__(Database)
+    db.engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+    Base.metadata.create_all(bind=db.engine)
+    db.migrate()
+
+    with db.engine.begin() as connection:
+        for iid in (1, 2, 3):
+            connection.execute(text(f"INSERT INTO instance (id, project_id, path, pointer, sha) "
+                                    f"VALUES ({iid}, 'p', '/tmp', {iid}, 'sha')"))
+            connection.execute(text(f"INSERT INTO compile_outcome (id, instance_id, tag, exit_status, flags) "
+                                    f"VALUES ({iid}, {iid}, 'build', 0, '{build_flags()}')"))
+
+    return db
+
+
+def get_handler(db: Database, **config) -> Handler:
+    handler = Handler()
+    handler.app = SimpleNamespace(get_config=lambda key: config.get(key, None), pargs=SimpleNamespace(verbose=False),
+                                  log=Log(), db=db)
+
+    return handler
+
+
+def get_context(iid: int = 3) -> SimpleNamespace:
+    return SimpleNamespace(instance=SimpleNamespace(id=iid, pointer=iid), project=SimpleNamespace(name='p', id='p'))
+
+
+def get_oracle(**cases: str):
+    # each case runs its shell command
+    return parse_oracle({'script': 'sh -c', 'cases': {name: {'order': order, 'file': 'test.sh', 'args': f"'{cmd}'"}
+                                                      for order, (name, cmd) in enumerate(cases.items())}},
+                        is_pov=False)
+
+
+def test_run_batch(db):
+    handler = get_handler(db)
+    oracle = get_oracle(t1='exit 0', t2='echo fail >&2; exit 1', t3='echo $ORBIS_WORKER')
+    results = handler.run_batch(get_context(), oracle, timeout=5, workers=2)
+
+    assert [(outcome.name, outcome.passed) for _, outcome in results] == [('t1', True), ('t2', False), ('t3', True)]
+    assert results[2][0].output.strip() in ['0', '1']
+    assert db.count(Outcome) == 3
+
+
+def test_run_batch_context(db):
+    # the commands run in the executor threads are streamed to the channels of the caller
+    broker = get_broker()
+    subscription = broker.subscribe('instance:3')
+
+    try:
+        with streaming('instance:3'):
+            get_handler(db).run_batch(get_context(), get_oracle(t1='echo one', t2='echo two'), timeout=5, workers=2)
+    finally:
+        broker.unsubscribe(subscription)
+
+    events, _ = subscription.get(timeout=0)
+
+    assert sorted(event['line'] for event in events if event['event'] == 'line') == ['one\n', 'two\n']
+
+
+def test_run_batch_pool_limit(db, monkeypatch):
+    monkeypatch.setattr(db, 'get_pool_limit', lambda: 1)
+    handler = get_handler(db)
+    results = handler.run_batch(get_context(), get_oracle(t1='echo $ORBIS_WORKER', t2='echo $ORBIS_WORKER'),
+                                timeout=5, workers=4)
+
+    assert [cmd_data.output for cmd_data, _ in results] == ['0\n', '0\n']
+    assert "Running the tests with 1 workers, the size of the database pool." in handler.app.log.messages
+
+
+def test_outcome_writer(db, monkeypatch):
+    errors = []
+    writer = OutcomeWriter(db, batch_size=3, interval=60, log=errors.append)
+    outcome = lambda name: Outcome(instance_id=3, co_id=3, name=name, order=0, is_pov=False, passed=True, exit_status=0,
+                                   duration=0)
+
+    writer.add(outcome('t1'))
+    writer.add(outcome('t2'))
+    assert len(writer) == 2 and db.count(Outcome) == 0
+
+    # full buffer
+    writer.add(outcome('t3'))
+    assert len(writer) == 0 and db.count(Outcome) == 3
+
+    # the interval passed, the flush fails and is retried with the next one
+    writer.interval = 0.01
+    monkeypatch.setattr(db, 'add_all', lambda entities: 1 / 0)
+    writer.add(outcome('t4'))
+    time.sleep(0.02)
+    writer.add(outcome('t5'))
+    assert len(writer) == 2 and len(errors) == 1
+
+    monkeypatch.undo()
+    writer.flush()
+    assert len(writer) == 0 and db.count(Outcome) == 5
+
+
+def add_outcomes(db: Database, iid: int, name: str, *passed: bool, duration: float = 1, is_pov: bool = False):
+    db.add_all([Outcome(instance_id=iid, co_id=iid, name=name, order=0, is_pov=is_pov, passed=p, exit_status=0,
+                        duration=duration) for p in passed])
+
+
+def test_history_povs(db):
+    # the povs are apart from the tests with the same name
+    add_outcomes(db, 1, 't1', True, True)
+    add_outcomes(db, 1, 't1', False, is_pov=True)
+    stats = db.test_history('p').stats
+
+    assert (stats[('t1', False)].runs, stats[('t1', False)].failures) == (2, 0)
+    assert (stats[('t1', True)].runs, stats[('t1', True)].failures) == (1, 1)
+
+
+def test_run_batch_prioritize(db):
+    # t2 failed before, t3 is fast and failed once, t1 always passed
+    add_outcomes(db, 1, 't1', True, True, True)
+    add_outcomes(db, 1, 't2', False, False, True, duration=2)
+    add_outcomes(db, 1, 't3', True, True, False, duration=0.1)
+    oracle = get_oracle(t1='echo t1 >> order', t2='echo t2 >> order', t3='echo t3 >> order')
+    handler = get_handler(db)
+
+    with tempfile.TemporaryDirectory() as cwd:
+        results = handler.run_batch(get_context(), oracle, timeout=5, workers=1, cwd=cwd, prioritize=True)
+        order = Path(cwd, 'order').read_text().split()
+
+    assert order == ['t3', 't2', 't1']
+    # the results keep the order of the oracle
+    assert [outcome.name for _, outcome in results] == ['t1', 't2', 't3']
+
+
+def test_run_batch_fail_fast(db):
+    oracle = get_oracle(t1='exit 0', t2='echo fail >&2; exit 1', t3='exit 0', t4='exit 0')
+    handler = get_handler(db)
+    results = handler.run_batch(get_context(), oracle, timeout=5, workers=1, fail_fast=True)
+    outcomes = [(outcome.name, outcome.passed, outcome.skipped) for _, outcome in results]
+
+    assert outcomes == [('t1', True, False), ('t2', False, False), ('t3', False, True), ('t4', False, True)]
+    # the skipped test cases are not saved
+    assert db.count(Outcome) == 2
+    assert "Stopped at the first failure, skipped 2 tests." in handler.app.log.messages
+
+
+def test_run_cached(db, tmp_path):
+    counter = tmp_path / 'runs'
+    test = get_oracle(t1=f'echo run >> {counter}').cases['t1']
+    handler = get_handler(db)
+    _, outcome = handler.run(get_context(), test, timeout=5, script='sh -c', fingerprint='f')
+    cmd_data, replayed = handler.run(get_context(), test, timeout=5, script='sh -c', fingerprint='f')
+
+    assert cmd_data.memoized and replayed.cached and replayed.fingerprint == outcome.fingerprint
+    assert counter.read_text() == 'run\n'
+    # the replayed outcome is not a run of the test
+    assert db.test_history('p').stats[('t1', False)].runs == 1
+
+    # another build with the same fingerprint and flags reuses the outcome
+    _, rebuilt = handler.run(get_context(2), test, timeout=5, script='sh -c', fingerprint='f')
+
+    assert rebuilt.cached and rebuilt.co_id == 2 and counter.read_text() == 'run\n'
+
+    # a different fingerprint or different flags do not
+    _, other = handler.run(get_context(), test, timeout=5, script='sh -c', fingerprint='g')
+
+    with db.engine.begin() as connection:
+        connection.execute(text(f"UPDATE compile_outcome SET flags = '{build_flags({'-j': 4})}' WHERE id = 1"))
+
+    _, flagged = handler.run(get_context(1), test, timeout=5, script='sh -c', fingerprint='f')
+
+    assert not other.cached and not flagged.cached and counter.read_text() == 'run\n' * 3
+
+
+def attempts(*passed: bool):
+    return [(CommandData(args='test'), Outcome(name='t1', passed=p, duration=i)) for i, p in enumerate(passed)]
+
+
+def test_majority():
+    assert _majority(attempts(True, False, True)) is True
+    assert _majority(attempts(False, False, True)) is False
+    assert _majority(attempts(True, False)) is None
+
+
+def test_settle():
+    # the latest run with the result of the majority
+    _, outcome = Handler._settle(attempts(True, False, True, False, False))
+    assert (outcome.passed, outcome.duration, outcome.confidence) == (False, 4, 0.6)
+
+    # on ties, the result of the latest run
+    _, outcome = Handler._settle(attempts(False, True))
+    assert (outcome.passed, outcome.duration, outcome.confidence) == (True, 1, 0.5)
+
+    # a single run, from the flakiness of the test
+    _, outcome = Handler._settle(attempts(True), flakiness=0.25)
+    assert (outcome.passed, outcome.confidence) == (True, 0.75)
+
+
+def test_history_flaky(db):
+    # t1 passed and failed on the second build of the instance, but not across the builds
+    add_outcomes(db, 1, 't1', True, True)
+    add_outcomes(db, 2, 't1', False, False)
+    db.add_all([Outcome(instance_id=2, co_id=4, name='t1', order=0, is_pov=False, passed=p, exit_status=0, duration=1)
+                for p in (True, False)])
+    history = db.test_history('p')
+    test = get_oracle(t1='exit 0').cases['t1']
+
+    assert history.flakiness(test) == pytest.approx(1 / 3)
+    assert history.is_flaky(test, 0.3) and not history.is_flaky(test, 1 / 3)
+
+
+def test_run_batch_reruns(db, tmp_path):
+    # t1 failed and passed on each build, its first run fails and the reruns pass
+    for iid in (1, 2):
+        add_outcomes(db, iid, 't1', True, False)
+
+    oracle = get_oracle(t1=f'test -e {tmp_path}/ran || {{ touch {tmp_path}/ran; echo fail >&2; exit 1; }}')
+    handler = get_handler(db, flaky={'threshold': 0.05, 'reruns': 2})
+    handler.get_fingerprint = lambda context, env: 'f'
+    (_, outcome), = handler.run_batch(get_context(), oracle, timeout=5, workers=1, cache=True)
+
+    assert outcome.passed and outcome.confidence == 0.667
+    # the settled outcome is the one reused for the fingerprint, not the first run
+    cmd_data, replayed = handler.run(get_context(), oracle.cases['t1'], timeout=5, script='sh -c', fingerprint='f')
+
+    assert cmd_data.memoized and replayed.passed
+    assert db.count(Outcome) == 4 + 3 + 1
+
+
+def test_history_percentile(db):
+    # the run that timed out is left out
+    for duration in [0.5, 10, 2, 9, 3, 8, 4, 7, 5, 6]:
+        add_outcomes(db, 1, 't1', True, duration=duration)
+
+    db.add(Outcome(instance_id=1, co_id=1, name='t1', order=0, is_pov=False, passed=False, exit_status=0,
+                   duration=60, error="Test timed out"))
+    test = get_oracle(t1='exit 0').cases['t1']
+
+    assert db.test_history('p', percentile=90).timeout(test, factor=2, min_runs=5) == 18
+    assert db.test_history('p', percentile=100).timeout(test, factor=1) == 10
+    assert db.test_history('p', percentile=0).timeout(test, factor=1) == 0.5
+    assert db.test_history('p', percentile=90).timeout(test, min_runs=11) is None
+    assert db.test_history('p').timeout(test) is None
+
+
+def test_run_batch_adaptive_timeout(db):
+    for duration in [0.1, 0.2, 0.3, 0.4, 1.1]:
+        add_outcomes(db, 1, 't1', True, duration=duration)
+
+    handler = get_handler(db, adaptive_timeout={'percentile': 80, 'factor': 2, 'min_runs': 5, 'minimum': 0})
+    (cmd_data, _), (other, _) = handler.run_batch(get_context(), get_oracle(t1='exit 0', t2='exit 0'), timeout=30,
+                                                  workers=1, adaptive_timeout=True)
+
+    # 0.4 * 2, in whole seconds
+    assert cmd_data.timeout == 1 and isinstance(cmd_data.timeout, int)
+    assert other.timeout == 30
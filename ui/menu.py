@@ -171,7 +171,7 @@ with st.sidebar:
 if selected == "Projects":
     if 'projects' not in st.session_state:
         r = requests.get(url=f"{base_url}/projects")
-        st.session_state.projects = r.json()
+        st.session_state.projects = r.json().get('items', {})
 
     cols = st.columns(3)
 
@@ -193,7 +193,7 @@ if selected == "Projects":
 if selected == "Vulnerabilities":
     if 'vulns' not in st.session_state:
         r = requests.get(url=f"{base_url}/vulns")
-        st.session_state.vulns = r.json()
+        st.session_state.vulns = r.json().get('items', {})
 
     cols = st.columns(3)
 
@@ -211,7 +211,7 @@ if selected == "Vulnerabilities":
 
 if selected == "Instances":
     r = requests.get(url=f"{base_url}/instances")
-    instances = r.json()
+    instances = r.json().get('items', {})
     cols = st.columns(3)
     last = None
 